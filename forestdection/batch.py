@@ -0,0 +1,130 @@
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from forestdection.filepath import FilepathProvider, get_filepath
+from forestdection.gdal_cache import dataset_cache
+from forestdection.main import Main
+from forestdection.service import IndicatorCalculation
+
+
+class BatchDriver:
+    # Runs Main for every tile, a tile is a base folder with the usual input / result / tmp layout (tiles_folder/<tile>)
+    # Every tile is resumable by itself: finished artifacts are in its build manifest, finished indicator windows in its journals,
+    # so a batch which is started again continues where it stopped, tiles which are done in the batch journal are skipped
+    # Tiles run concurrently in worker processes (FilepathProvider.base_folder is global), as many as fit into memory_budget
+    tiles_folder = '/shares/mfue1/teaching/stu_scratch/Microwave_Remote_Sensing/Group1/tiles'
+    tiles = None  # names of the tiles, all folders of tiles_folder if not set
+    hlr_tiles = None  # HRL tile of every tile (e.g. {'E052N015T1': 'FTY_2015_020m_eu_03035_d04_E40N20'}), else the only one in its input
+    memory_budget = 8 * 1024 ** 3
+    tile_memory_budget = 2 * 1024 ** 3  # memory budget of the indicator cubes of one tile
+
+    def __init__(self, tiles_folder: str = None, tiles: List[str] = None, memory_budget: int = None, tile_memory_budget: int = None,
+                 hlr_tiles: Dict[str, str] = None):
+        if tiles_folder:
+            self.tiles_folder = tiles_folder
+        if tiles:
+            self.tiles = tiles
+        if hlr_tiles:
+            self.hlr_tiles = hlr_tiles
+        if memory_budget:
+            self.memory_budget = memory_budget
+        if tile_memory_budget:
+            self.tile_memory_budget = tile_memory_budget
+
+    def get_tiles(self) -> List[str]:
+        if self.tiles:
+            return list(self.tiles)
+        return sorted(name for name in os.listdir(self.tiles_folder) if os.path.isdir(os.path.join(self.tiles_folder, name)))
+
+    def get_hlr_tile(self, tile: str) -> Optional[str]:
+        return self.hlr_tiles.get(tile) if self.hlr_tiles else None
+
+    def get_concurrent_tiles(self) -> int:
+        return max(1, self.memory_budget // self.tile_memory_budget)
+
+    def run(self, build: bool = False) -> Dict[str, dict]:
+        # Failing tiles do not stop the others, the state of every tile is written to the batch journal
+        # Tiles which are done are skipped, build ... all tiles are processed again
+        journal = self.read_journal()
+        tiles = [tile for tile in self.get_tiles() if build or journal.get(tile, {}).get('state') != 'done']
+        concurrent_tiles = min(self.get_concurrent_tiles(), max(len(tiles), 1))
+        print(f'Processing {len(tiles)} tiles, {concurrent_tiles} at a time')
+
+        if concurrent_tiles <= 1:
+            for tile in tiles:
+                journal[tile] = self._run_tile(tile, build)
+                self.write_journal(journal)
+        else:
+            with ProcessPoolExecutor(max_workers=concurrent_tiles) as executor:
+                futures = {executor.submit(run_tile, self.get_tile_folder(tile), self.tile_memory_budget, build, self.get_hlr_tile(tile)):
+                           tile for tile in tiles}
+                for future in as_completed(futures):
+                    journal[futures[future]] = self._get_state(future)
+                    self.write_journal(journal)
+        return journal
+
+    def get_tile_folder(self, tile: str) -> str:
+        return os.path.join(self.tiles_folder, tile)
+
+    def read_journal(self) -> Dict[str, dict]:
+        journal_path = self.get_journal_path()
+        if not os.path.isfile(journal_path):
+            return {}
+        with open(journal_path, 'r') as file:
+            return json.load(file)
+
+    def write_journal(self, journal: Dict[str, dict]):
+        journal_path = self.get_journal_path()
+        tmp_path = f'{journal_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(journal, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, journal_path)
+
+    def get_journal_path(self) -> str:
+        return get_filepath(self.tiles_folder, 'batch_journal.json')
+
+    def _run_tile(self, tile: str, build: bool) -> dict:
+        try:
+            mmu_classified = run_tile(self.get_tile_folder(tile), self.tile_memory_budget, build, self.get_hlr_tile(tile))
+            return {'state': 'done', 'mmu_classified': mmu_classified}
+        except Exception as error:
+            traceback.print_exc()
+            return {'state': 'failed', 'error': repr(error)}
+
+    def _get_state(self, future) -> dict:
+        try:
+            return {'state': 'done', 'mmu_classified': future.result()}
+        except Exception as error:
+            print(f'Tile failed: {error}')
+            return {'state': 'failed', 'error': repr(error)}
+
+
+def run_tile(base_folder: str, memory_budget: int = None, build: bool = False, hlr_tile: str = None) -> str:
+    # Module level so it can be pickled into the worker processes, returns the path of the filtered classification
+    # hlr_tile ... HRL tile the accuracy of this tile is measured against, the only one in its input folder if not set
+    previous_base_folder, previous_hlr_tile = FilepathProvider.base_folder, FilepathProvider.copernicus_hlr_tile
+    try:
+        FilepathProvider.base_folder = base_folder
+        FilepathProvider.copernicus_hlr_tile = hlr_tile if hlr_tile else get_hlr_tile(base_folder)
+        main = Main()
+        main.indicator_calculation = IndicatorCalculation(memory_budget=memory_budget)
+        print(f'Tile {base_folder}')
+        return main.build_mmu_classified(build)
+    finally:
+        FilepathProvider.base_folder, FilepathProvider.copernicus_hlr_tile = previous_base_folder, previous_hlr_tile
+        dataset_cache.close_all()
+
+
+def get_hlr_tile(base_folder: str) -> str:
+    hlr_folder = os.path.join(base_folder, 'input', 'sentinel_hlr')
+    hlr_tiles = sorted(os.listdir(hlr_folder)) if os.path.isdir(hlr_folder) else []
+    if len(hlr_tiles) != 1:
+        raise ValueError(f'{hlr_folder} does not contain exactly one HRL tile, set it per tile')
+    return hlr_tiles[0]
+
+
+if __name__ == '__main__':
+    BatchDriver().run()
@@ -0,0 +1,245 @@
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import List, Dict
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from forestdection.filepath import FilepathProvider, get_filepath
+from forestdection.gdal_cache import dataset_cache
+from forestdection.main import Main
+from forestdection.profiling import get_peak_rss
+
+
+class SyntheticDataGenerator:
+    # Int16 sig0 monthly means (dB * 100), reference shapes and a HRL of a random forest map in base_folder's layout
+    # The map consists of square patches of one class: 0 ... no forest, 1 ... first forest type, 2 ... second forest type
+    forest_types = ['broadleaf', 'coniferous']
+    polarizations = ['VV', 'VH']
+    epsg = 3035
+    origin = (5200000.0, 1600000.0)
+    pixel_size = 10.0
+    patch_size = 50
+    reference_patches = 20  # patches per forest type in its reference shape
+    noise_std = 0.7  # dB
+    nodata_fraction = 0.01
+    factor = 100
+    nodata = -9999
+    rows_per_write = 1024
+    creation_options = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'PREDICTOR=2']
+    # mean and seasonal amplitude of sig0 in dB by class and polarization
+    signals = {'VV': [(-10.0, 3.0), (-8.0, 1.5), (-8.0, 0.3)],
+               'VH': [(-17.0, 3.0), (-14.0, 1.5), (-13.0, 0.3)]}
+
+    def __init__(self, base_folder: str, size: int, months: int, seed: int = 0):
+        self.filepath_provider = FilepathProvider()
+        self.filepath_provider.base_folder = base_folder
+        self.size = size
+        self.months = months
+        self.random_state = np.random.RandomState(seed)
+        self.patch_size = max(1, min(self.patch_size, size // 8))
+        self.classes = self.get_classes()
+
+    def generate(self):
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(self.epsg)
+        wkt = srs.ExportToWkt()
+
+        for polarization in self.polarizations:
+            for month in range(self.months):
+                self.write_monthly_mean(polarization, month, wkt)
+        for class_value, forest_type in enumerate(self.forest_types, 1):
+            self.write_reference_shape(forest_type, class_value, srs)
+        self.write_hrl(wkt)
+
+    def get_classes(self) -> np.array:
+        patches = -(-self.size // self.patch_size)
+        patch_classes = self.random_state.choice([0, 1, 2], size=(patches, patches), p=[0.4, 0.3, 0.3]).astype(np.uint8)
+        patch_classes.flat[:3] = [0, 1, 2]  # every class is present, also in small rasters
+        classes = np.repeat(np.repeat(patch_classes, self.patch_size, axis=0), self.patch_size, axis=1)
+        return classes[:self.size, :self.size]
+
+    def get_filename(self, polarization: str, month: int) -> str:
+        # Same pattern as the real monthly means: date in the first, polarization in the fourth part
+        year, month_of_year = 2017 + month // 12, month % 12 + 1
+        return f'M{year}{month_of_year:02d}01_{year}{month_of_year:02d}28--_SIG0-----_{polarization}D----_A0000_1_EU010M_E052N015T1.tif'
+
+    def write_monthly_mean(self, polarization: str, month: int, wkt: str):
+        path = get_filepath(self.filepath_provider.get_sig0_mm_folder(), self.get_filename(polarization, month))
+        signal = np.array([mean + amplitude * np.cos(2 * np.pi * (month % 12 - 6) / 12) for mean, amplitude in self.signals[polarization]])
+
+        ds = self._create(path, gdal.GDT_Int16, wkt, self.nodata)
+        band = ds.GetRasterBand(1)
+        for row_off in range(0, self.size, self.rows_per_write):
+            classes = self.classes[row_off:row_off + self.rows_per_write]
+            sig0 = signal[classes] + self.random_state.normal(scale=self.noise_std, size=classes.shape)
+            data = np.rint(sig0 * self.factor).astype(np.int16)
+            data[self.random_state.random_sample(classes.shape) < self.nodata_fraction] = self.nodata
+            band.WriteArray(data, 0, row_off)
+        band.FlushCache()
+        del band
+        del ds
+
+    def write_reference_shape(self, forest_type: str, class_value: int, srs: osr.SpatialReference):
+        path = get_filepath(self.filepath_provider.get_shape_folder(), f'{forest_type}.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        ds = driver.CreateDataSource(path)
+        layer = ds.CreateLayer(forest_type, srs, ogr.wkbPolygon)
+
+        # whole patches of the forest type, so the reference is pure
+        patch_rows, patch_cols = np.nonzero(self.classes[::self.patch_size, ::self.patch_size] == class_value)
+        selected = self.random_state.permutation(len(patch_rows))[:self.reference_patches]
+        for patch_row, patch_col in zip(patch_rows[selected], patch_cols[selected]):
+            row_min, col_min = patch_row * self.patch_size, patch_col * self.patch_size
+            row_max, col_max = min(row_min + self.patch_size, self.size), min(col_min + self.patch_size, self.size)
+            x_min, x_max = self.origin[0] + col_min * self.pixel_size, self.origin[0] + col_max * self.pixel_size
+            y_min, y_max = self.origin[1] - row_max * self.pixel_size, self.origin[1] - row_min * self.pixel_size
+
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max), (x_min, y_min)]:
+                ring.AddPoint_2D(x, y)
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(polygon)
+            layer.CreateFeature(feature)
+            feature = None
+        del layer
+        del ds  # Flush
+
+    def write_hrl(self, wkt: str):
+        ds = self._create(self.filepath_provider.get_copernicus_hlr_file(), gdal.GDT_Byte, wkt, 255)
+        band = ds.GetRasterBand(1)
+        band.WriteArray(self.classes)
+        band.FlushCache()
+        del band
+        del ds
+
+    def _create(self, path: str, data_type: int, wkt: str, nodata) -> gdal.Dataset:
+        ds = gdal.GetDriverByName('GTiff').Create(path, self.size, self.size, 1, data_type, self.creation_options)
+        ds.SetGeoTransform((self.origin[0], self.pixel_size, 0, self.origin[1], 0, -self.pixel_size))
+        ds.SetProjection(wkt)
+        ds.GetRasterBand(1).SetNoDataValue(nodata)
+        return ds
+
+
+class Benchmark:
+    # Runs the hot paths of Main on synthetic rasters of every size x months case
+    # per stage: wall time, throughput in million pixels (raster pixels x bands read) per second,
+    # peak of the numpy / python allocations (tracemalloc, GDAL's own memory is not traced) and the peak RSS so far
+    sizes = [1000, 5000, 10000]
+    months = [12, 48]
+    regression_tolerance = 1.2  # slower or more memory than the baseline by this factor is a regression
+
+    def run(self, sizes: List[int] = None, months: List[int] = None, keep: bool = False) -> Dict[str, Dict[str, dict]]:
+        results = OrderedDict()
+        for size in sizes if sizes else self.sizes:
+            for num_months in months if months else self.months:
+                print(f'\nBenchmark {self.get_case_name(size, num_months)}')
+                results[self.get_case_name(size, num_months)] = self.run_case(size, num_months, keep=keep)
+        return results
+
+    def run_case(self, size: int, months: int, folder: str = None, keep: bool = False) -> Dict[str, dict]:
+        folder = folder if folder else tempfile.mkdtemp(prefix='forestdection_benchmark_')
+        base_folder = FilepathProvider.base_folder
+        FilepathProvider.base_folder = folder
+        try:
+            SyntheticDataGenerator(folder, size, months).generate()
+            return self.run_stages(Main(), size * size, months)
+        finally:
+            FilepathProvider.base_folder = base_folder
+            dataset_cache.close_all()
+            if not keep:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    def run_stages(self, main: Main, pixels: int, months: int) -> Dict[str, dict]:
+        stages = OrderedDict()
+        all_mm_paths = main.filepath_provider.get_input_mm_files_by_polarisation()
+        all_bands = pixels * months * len(all_mm_paths)
+
+        all_reference_timeseries = self.measure(stages, 'reference_timeseries', all_bands, main.get_all_reference_timeseries, build=True)
+        reference_timeseries = all_reference_timeseries[0]
+        mm_paths = all_mm_paths[reference_timeseries.polarization]
+        self.measure(stages, 'rmsd', pixels * months, main.indicator_calculation.get_rmsd, reference_timeseries, mm_paths)
+        self.measure(stages, 'pearson', pixels * months, main.indicator_calculation.get_pearson, reference_timeseries, mm_paths)
+        self.measure(stages, 'all_indicators', all_bands, main.build_all_indicators, build=True)
+
+        classified_path = self.measure(stages, 'classify_forest', pixels, main.build_classified, build=True)
+        classified_profile = main.tif_reader_writer.get_profile(main.classified_profile)
+        self.measure(stages, 'mmu', pixels, main.comparison_utils.write_mmu, classified_path, main.filepath_provider.get_classified_mmu_file(),
+                     main._get_tif_info(classified_path), classified_profile)
+        self.measure(stages, 'accuracy', pixels, main.cmatrix.get_tiled_confusion_matrix, classified_path,
+                     main.filepath_provider.get_copernicus_hlr_file())
+        return stages
+
+    def measure(self, stages: Dict[str, dict], name: str, pixels: int, func, *args, **kwargs):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stages[name] = {'seconds': round(seconds, 4), 'mpix_per_s': round(pixels / seconds / 1e6, 3),
+                        'peak_mb': round(peak / 1e6, 1), 'peak_rss_mb': round(get_peak_rss() / 1e6, 1)}
+        print(f'{name}: {stages[name]}')
+        return result
+
+    def compare(self, results: Dict[str, Dict[str, dict]], baseline: Dict[str, Dict[str, dict]]) -> List[str]:
+        regressions = []
+        for case_name, stages in results.items():
+            for name, stage in stages.items():
+                baseline_stage = baseline.get(case_name, {}).get(name)
+                if not baseline_stage:
+                    continue
+                time_ratio = stage['seconds'] / baseline_stage['seconds'] if baseline_stage['seconds'] else 1.0
+                memory_ratio = stage['peak_mb'] / baseline_stage['peak_mb'] if baseline_stage['peak_mb'] else 1.0
+                print(f'{case_name} {name}: {time_ratio:.2f}x time, {memory_ratio:.2f}x memory of the baseline')
+                if time_ratio > self.regression_tolerance or memory_ratio > self.regression_tolerance:
+                    regressions.append(f'{case_name} {name}')
+        return regressions
+
+    def get_case_name(self, size: int, months: int) -> str:
+        return f'{size}x{size}x{months}'
+
+    def read_results(self, input_path: str) -> Dict[str, Dict[str, dict]]:
+        with open(input_path, 'r') as file:
+            return json.load(file)
+
+    def write_results(self, results: Dict[str, Dict[str, dict]], output_path: str):
+        with open(output_path, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the indicator and classification hot paths on synthetic rasters')
+    parser.add_argument('--sizes', type=int, nargs='+', default=Benchmark.sizes)
+    parser.add_argument('--months', type=int, nargs='+', default=Benchmark.months)
+    parser.add_argument('--baseline', help='baseline json, results are compared against it')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results as new baseline')
+    parser.add_argument('--output', help='results json')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic rasters')
+    args = parser.parse_args()
+
+    benchmark = Benchmark()
+    benchmark_results = benchmark.run(args.sizes, args.months, args.keep)
+    if args.output:
+        benchmark.write_results(benchmark_results, args.output)
+    if args.baseline and args.update_baseline:
+        benchmark.write_results(benchmark_results, args.baseline)
+    elif args.baseline and os.path.isfile(args.baseline):
+        benchmark_regressions = benchmark.compare(benchmark_results, benchmark.read_results(args.baseline))
+        if benchmark_regressions:
+            print(f'Regressions: {benchmark_regressions}')
+            sys.exit(1)
@@ -0,0 +1,112 @@
+import glob
+import hashlib
+import json
+import os
+from typing import List, Tuple
+
+
+class BuildCache:
+    # Small inputs (shapefiles, timeseries csv) are hashed by content, large rasters by size and mtime
+    content_hash_limit = 1024 * 1024
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.manifest = self._read_manifest()
+
+    def get_key(self, input_paths: List[str], params: dict = None, version: int = None) -> str:
+        # Key of an artifact, changes if any input file, parameter or the version of the code which calculates it changes
+        # version ... constant of the calculating class, raised with every change of its results, other code changes keep the artifacts
+        key = hashlib.sha1()
+        key.update(str(version).encode())
+        key.update(json.dumps(params if params else {}, sort_keys=True).encode())
+        for path in input_paths:
+            key.update(self.get_file_signature(path).encode())
+        return key.hexdigest()
+
+    def get_file_signature(self, path: str) -> str:
+        if not os.path.isfile(path):
+            return f'{path}:missing'
+        stat = os.stat(path)
+        if stat.st_size <= self.content_hash_limit:
+            with open(path, 'rb') as file:
+                return f'{path}:{hashlib.sha1(file.read()).hexdigest()}'
+        return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def is_valid(self, artifact_paths: List[str], key: str) -> bool:
+        return all(os.path.isfile(path) and self.manifest.get(path) == key for path in artifact_paths)
+
+    def update(self, artifact_paths: List[str], key: str):
+        for path in artifact_paths:
+            self.manifest[path] = key
+        self._write_manifest()
+
+    def _read_manifest(self) -> dict:
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        with open(self.manifest_path, 'r') as file:
+            return json.load(file)
+
+    def _write_manifest(self):
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class WindowJournal:
+    # Windows of a streamed artifact which are completely written, a run with the same key resumes after them
+    # One json line per window, appended after the window is flushed, a torn last line of a crash is ignored
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        self.windows = self._read()
+
+    def is_done(self, window: Tuple[int, int, int, int]) -> bool:
+        return tuple(window) in self.windows
+
+    def has_progress(self) -> bool:
+        return bool(self.windows)
+
+    def add(self, window: Tuple[int, int, int, int]):
+        if not os.path.isfile(self.path):
+            self._write_header()
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(list(window)) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.windows.add(tuple(window))
+
+    def reset(self):
+        self.windows = set()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _read(self) -> set:
+        if not os.path.isfile(self.path):
+            return set()
+        with open(self.path, 'r') as file:
+            lines = file.read().splitlines()
+        if not lines or lines[0] != json.dumps({'key': self.key}):
+            os.remove(self.path)  # other inputs, parameters or code, the windows are invalid
+            return set()
+        windows = []
+        for line in lines[1:]:
+            try:
+                windows.append(tuple(json.loads(line)))
+            except ValueError:
+                self._write_header(windows)  # later lines would be appended to the torn one
+                break
+        return set(windows)
+
+    def _write_header(self, windows: List[Tuple[int, int, int, int]] = None):
+        with open(self.path, 'w') as file:
+            file.write(json.dumps({'key': self.key}) + '\n')
+            for window in windows if windows else []:
+                file.write(json.dumps(list(window)) + '\n')
+
+
+def get_shape_paths(shape_path: str) -> List[str]:
+    # A shapefile consists of several files (.shp, .shx, .dbf, .prj, ...)
+    return sorted(glob.glob(f'{os.path.splitext(shape_path)[0]}.*'))
+
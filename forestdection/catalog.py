@@ -0,0 +1,123 @@
+import json
+import os
+from threading import Lock
+from typing import List, Optional
+
+from forestdection.domain import TifInfo
+
+
+class RasterCatalog:
+    # Parsed names and georeferencing of all rasters of a folder, persisted as json next to the other tmp files
+    # Rescanned only if the mtime of the folder changed (files added, removed or renamed), files which are unchanged
+    # (same size and mtime) keep their entry and are not opened again
+    # entry: path, name, date (YYYY-MM), polarization, grid (e.g. EU010M), tile (e.g. E052N015T1), file_size, mtime_ns, tif_info
+    version = 1
+
+    def __init__(self, folder: str, catalog_path: str):
+        self.folder = folder
+        self.catalog_path = catalog_path
+        self.entries = None
+        self.folder_mtime_ns = None
+        self.lock = Lock()
+
+    def get_entries(self) -> List[dict]:
+        with self.lock:
+            folder_mtime_ns = os.stat(self.folder).st_mtime_ns  # before listing, a file added while scanning triggers the next scan
+            if self.entries is not None and self.folder_mtime_ns == folder_mtime_ns:
+                return self.entries
+
+            catalog = self._read()
+            if catalog.get('version') == self.version and catalog.get('folder') == self.folder \
+                    and catalog.get('folder_mtime_ns') == folder_mtime_ns:
+                self.entries = catalog['entries']
+            else:
+                print(f'Scanning {self.folder}')
+                self.entries = self._scan({entry['path']: entry for entry in catalog.get('entries', [])})
+                self._write(folder_mtime_ns)
+            self.folder_mtime_ns = folder_mtime_ns
+            return self.entries
+
+    def query(self, polarization: str = None, date_from: str = None, date_to: str = None, tile: str = None, grid: str = None) -> List[dict]:
+        # dates as YYYY-MM, both included, sorted by name (starts with the date)
+        return [entry for entry in self.get_entries()
+                if (not polarization or entry['polarization'] == polarization)
+                and (not date_from or entry['date'] >= date_from) and (not date_to or entry['date'] <= date_to)
+                and (not tile or entry['tile'] == tile) and (not grid or entry['grid'] == grid)]
+
+    def get_paths(self, polarization: str = None, date_from: str = None, date_to: str = None, tile: str = None, grid: str = None) -> List[str]:
+        return [entry['path'] for entry in self.query(polarization, date_from, date_to, tile, grid)]
+
+    def get_entry(self, path: str) -> Optional[dict]:
+        for entry in self.get_entries():
+            if entry['path'] == path:
+                return entry
+        return None
+
+    def get_tif_info(self, path: str) -> Optional[TifInfo]:
+        entry = self.get_entry(path)
+        return TifInfo.from_dict(entry['tif_info']) if entry else None
+
+    def _scan(self, old_entries: dict) -> List[dict]:
+        entries = []
+        for name in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, name)
+            if not os.path.isfile(path):
+                continue
+            entry = parse_mm_filename(name)
+            if entry is None:
+                continue
+
+            stat = os.stat(path)
+            old_entry = old_entries.get(path)
+            if old_entry and old_entry['file_size'] == stat.st_size and old_entry['mtime_ns'] == stat.st_mtime_ns:
+                entries.append(old_entry)
+                continue
+            entry.update({'path': path, 'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'tif_info': self._get_tif_info_dict(path)})
+            entries.append(entry)
+        return entries
+
+    def _get_tif_info_dict(self, path: str) -> dict:
+        return TifInfo(path).to_dict()
+
+    def _read(self) -> dict:
+        if not os.path.isfile(self.catalog_path):
+            return {}
+        try:
+            with open(self.catalog_path, 'r') as file:
+                return json.load(file)
+        except ValueError:
+            return {}  # torn file, rescanned
+
+    def _write(self, folder_mtime_ns: int):
+        tmp_path = f'{self.catalog_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'version': self.version, 'folder': self.folder, 'folder_mtime_ns': folder_mtime_ns, 'entries': self.entries}, file)
+        os.replace(tmp_path, self.catalog_path)
+
+
+def parse_mm_filename(name: str) -> Optional[dict]:
+    # e.g. M20170101_20170131--_SIG0-----_VVD----_..._EU010M_E052N015T1.tif, None if it is not a monthly mean
+    parts = os.path.splitext(name)[0].split('_')
+    if len(parts) < 4:
+        return None
+    if 'VV' in parts[3]:
+        polarization = 'VV'
+    elif 'VH' in parts[3]:
+        polarization = 'VH'
+    else:
+        return None
+    return {'name': name, 'date': f'{parts[0][1:5]}-{parts[0][5:7]}', 'polarization': polarization,
+            'grid': parts[-2] if len(parts) > 5 else None, 'tile': parts[-1] if len(parts) > 5 else None}
+
+
+_catalogs = {}
+_catalogs_lock = Lock()
+
+
+def get_catalog(folder: str, catalog_path: str) -> RasterCatalog:
+    # One catalog per folder and process, so its entries stay in memory between calls
+    with _catalogs_lock:
+        key = (folder, catalog_path)
+        if key not in _catalogs:
+            _catalogs[key] = RasterCatalog(folder, catalog_path)
+        return _catalogs[key]
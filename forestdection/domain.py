@@ -1,8 +1,10 @@
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 from osgeo import gdal
 
+from forestdection.gdal_cache import dataset_cache
+
 
 class Timeseries:
 
@@ -60,9 +62,10 @@ class RasterCube:
 
 
 class TifInfo:
+    dataset_cache = dataset_cache
 
     def __init__(self, path: str):
-        dataset = gdal.Open(path)
+        dataset: gdal.Dataset = self.dataset_cache.open(path)
 
         transform = dataset.GetGeoTransform()
         self.origin_x = transform[0]
@@ -75,49 +78,105 @@ class TifInfo:
         self.size_x = dataset.RasterXSize
         self.size_y = dataset.RasterYSize
 
+    def get_geo_transform(self) -> tuple:
+        return self.origin_x, self.pixel_width, 0, self.origin_y, 0, self.pixel_height
+
+    def to_dict(self) -> dict:
+        return {'origin_x': self.origin_x, 'origin_y': self.origin_y, 'pixel_width': self.pixel_width, 'pixel_height': self.pixel_height,
+                'wkt_projection': self.wkt_projection, 'size_x': self.size_x, 'size_y': self.size_y}
+
+    @classmethod
+    def from_dict(cls, values: dict):
+        # georeferencing stored next to a file which is not a tif (e.g. a TimeseriesCube)
+        tif_info = cls.__new__(cls)
+        tif_info.__dict__.update(values)
+        return tif_info
+
     def __eq__(self, other):
         return self.origin_x == other.origin_x and self.origin_y == other.origin_y \
-               and self.pixel_width == other.pixel_width and self.pixel_height == other.pixel_height \
-               and self.wkt_projection == other.wkt_projection \
-               and self.size_x == other.size_x and self.size_y == other.size_y
+            and self.pixel_width == other.pixel_width and self.pixel_height == other.pixel_height \
+            and self.wkt_projection == other.wkt_projection \
+            and self.size_x == other.size_x and self.size_y == other.size_y
 
 
 class Indicators:
+    # All indicators in one preallocated (rows, cols, k) array (or .npy memory map if path is given)
+    # indexed by (forest_type, polarization, type_), queries return views instead of stacked copies
 
-    def __init__(self):
+    def __init__(self, capacity: int = 8, path: str = None):
         self.forest_types = []
         self.polarizations = []
         self.types = []
-        self.data = []
+        self.index = {}
+        self.capacity = capacity
+        self.path = path
+        self.raster = None
 
     def push(self, forest_type: str, polarization: str, type_: str, data: np.array):
+        if self.raster is None:
+            self.raster = self._allocate(data.shape, data.dtype, self.capacity)
+        elif len(self.types) == self.raster.shape[2]:
+            self._grow()
+
+        layer = len(self.types)
+        self.raster[:, :, layer] = data
         self.forest_types.append(forest_type)
         self.polarizations.append(polarization)
         self.types.append(type_)
-        self.data.append(data)
+        self.index[(forest_type, polarization, type_)] = layer
 
     def push_all(self, forest_types: List[str], polarizations: List[str], types_: List[str], data: List[np.array]):
-        self.forest_types += forest_types
-        self.polarizations += polarizations
-        self.types += types_
-        self.data += data
+        for forest_type, polarization, type_, d in zip(forest_types, polarizations, types_, data):
+            self.push(forest_type, polarization, type_, d)
 
-    def get_data_by_description(self, forest_type: str = None, polarization: str = None, type_: str = None):
-        indices = self.get_part_indices(forest_type, polarization, type_)
-        data = [d for i, d in enumerate(self.data) if i in indices]
-        return np.dstack(data)
+    @property
+    def data(self) -> List[np.array]:
+        return [self.raster[:, :, layer] for layer in range(len(self.types))]
 
-    def get_part_indices(self, forest_type: str = None, polarization: str = None, type_: str = None):
-        indices = set(range(0, len(self.forest_types)))
+    def get_zip(self):
+        return zip(self.forest_types, self.polarizations, self.types, self.data)
 
-        if forest_type:
-            indices = self._get_indices_set(self.forest_types, forest_type) & indices
-        if polarization:
-            indices = self._get_indices_set(self.polarizations, polarization) & indices
-        if type_:
-            indices = self._get_indices_set(self.types, type_)
+    def get_data_by_description(self, forest_type: str = None, polarization: str = None, type_: str = None):
+        indices = sorted(self.get_part_indices(forest_type, polarization, type_))
+        if not indices:
+            raise ValueError(f'No indicator for {forest_type}, {polarization}, {type_}')
+        return self.raster[:, :, self._get_layer_slice(indices)]
 
+    def get_part_indices(self, forest_type: str = None, polarization: str = None, type_: str = None):
+        return {layer for (f, p, t), layer in self.index.items()
+                if (not forest_type or f == forest_type) and (not polarization or p == polarization) and (not type_ or t == type_)}
+
+    def get_window(self, window: Tuple[int, int, int, int]):
+        # View on (col_off, row_off, col_size, row_size) of the pushed layers, e.g. to classify tile by tile
+        # Descriptions are copied and a push grows into a new array, so the window never changes its parent
+        col_off, row_off, col_size, row_size = window
+        indicators = Indicators()
+        indicators.forest_types, indicators.polarizations = list(self.forest_types), list(self.polarizations)
+        indicators.types = list(self.types)
+        indicators.index = dict(self.index)
+        indicators.raster = self.raster[row_off:row_off + row_size, col_off:col_off + col_size, :len(self.types)]
+        return indicators
+
+    def get_shape(self) -> Tuple[int, int]:
+        return self.raster.shape[:2]
+
+    def _get_layer_slice(self, indices: List[int]):
+        # Evenly spaced layers (e.g. one per forest type) are a basic slice and therefore a view
+        if len(indices) == 1:
+            return slice(indices[0], indices[0] + 1)
+        step = indices[1] - indices[0]
+        if all(j - i == step for i, j in zip(indices, indices[1:])):
+            return slice(indices[0], indices[-1] + 1, step)
         return indices
 
-    def _get_indices_set(self, to_check: list, value) -> set:
-        return {i for i, j in enumerate(to_check) if j == value}
+    def _allocate(self, shape: Tuple[int, int], dtype, capacity: int) -> np.array:
+        if self.path:
+            return np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype, shape=(shape[0], shape[1], capacity))
+        return np.empty((shape[0], shape[1], capacity), dtype=dtype)
+
+    def _grow(self):
+        old = self.raster
+        if self.path:
+            old = np.array(old)  # the memory map is recreated at the same path
+        self.raster = self._allocate(old.shape[:2], old.dtype, old.shape[2] * 2)
+        self.raster[:, :, :old.shape[2]] = old
@@ -1,5 +1,8 @@
 import os
 
+from forestdection.catalog import RasterCatalog, get_catalog
+from forestdection.domain import TifInfo
+
 
 class FilenameProvider:
 
@@ -29,11 +32,13 @@ class FilepathProvider:
     # TODO make this smarter (e.g.: config path)
     filename_provider = FilenameProvider()
     base_folder = '/shares/mfue1/teaching/stu_scratch/Microwave_Remote_Sensing/Group1/data'
+    copernicus_hlr_tile = 'FTY_2015_020m_eu_03035_d04_E40N20'
+    use_catalog = True  # monthly means and their georeferencing from the cached catalog instead of listing / opening them
 
     def _get_and_make_folder(self, main, sub):
         path = os.path.join(self.base_folder, main, sub)
         if not os.path.isdir(path):
-            os.mkdir(path)
+            os.makedirs(path)
         return path
 
     # main folders
@@ -55,21 +60,30 @@ class FilepathProvider:
         return self._get_input_folder('reference_shape')
 
     def get_copernicus_hlr_folder(self):
-        return self._get_input_folder(os.path.join('sentinel_hlr', 'FTY_2015_020m_eu_03035_d04_E40N20'))
+        return self._get_input_folder(os.path.join('sentinel_hlr', self.copernicus_hlr_tile))
 
     # tmp
-    def get_cropped_mm_folder(self):
-        return self._get_tmp_folder('cropped_mm')
-
     def get_test_folder(self):
         return self._get_tmp_folder('test')
 
     def get_timeseries_folder(self):
         return self._get_tmp_folder('timeseries')
 
+    def get_timeseries_cube_folder(self):
+        return self._get_tmp_folder('timeseries_cube')
+
     def get_plot_folder(self):
         return self._get_tmp_folder('plot')
 
+    def get_job_folder(self):
+        return self._get_tmp_folder('job')
+
+    def get_profile_folder(self):
+        return self._get_tmp_folder('profile')
+
+    def get_catalog_folder(self):
+        return self._get_tmp_folder('catalog')
+
     # results
     def get_rmsd_folder(self):
         return self._get_result_folder('rmsd')
@@ -80,21 +94,28 @@ class FilepathProvider:
     def get_classified_folder(self):
         return self._get_result_folder('classified')
 
+    def get_statistics_folder(self, polarization: str):
+        return self._get_result_folder(os.path.join('statistics', polarization))
+
+    def get_journal_folder(self):
+        return self._get_result_folder('journal')
+
     # complete filepaths
     def get_copernicus_hlr_file(self):
         folder = self.get_copernicus_hlr_folder()
         name = 'Copernicus_HLR_repro_clip.tif'
         return get_filepath(folder, name)
 
-    def get_cropped_mm_file(self, input_filename, output_sufix):
-        output_filename = self.filename_provider.append_sufix_to_tif(input_filename, output_sufix)
-        return os.path.join(self.get_cropped_mm_folder(), output_filename)
-
     def get_timeseries_file(self, polarization: str, forest_type: str):
         folder = self.get_timeseries_folder()
         name = self.filename_provider.get_timeseries_filename(polarization, forest_type)
         return get_filepath(folder, name)
 
+    def get_timeseries_cube_file(self, polarization: str):
+        folder = self.get_timeseries_cube_folder()
+        name = f'timeseries_cube_{polarization}.npy'
+        return get_filepath(folder, name)
+
     def get_rmsd_file(self, polarization: str, forest_type: str):
         folder = self.get_rmsd_folder()
         name = self.filename_provider.get_rmsd_filename(polarization, forest_type)
@@ -105,18 +126,52 @@ class FilepathProvider:
         name = self.filename_provider.get_pearson_filename(polarization, forest_type)
         return get_filepath(folder, name)
 
+    def get_indicator_file(self, type_: str, polarization: str, forest_type: str):
+        indicator_file_funcs = {'rmsd': self.get_rmsd_file, 'pearson': self.get_pearson_file}
+        return indicator_file_funcs[type_](polarization, forest_type)
+
     def get_classified_file(self):
         folder = self.get_classified_folder()
         name = 'classified.tif'
         return get_filepath(folder, name)
 
+    def get_classified_mmu_file(self):
+        folder = self.get_classified_folder()
+        name = 'classified_mmu.tif'
+        return get_filepath(folder, name)
+
+    def get_build_manifest_file(self):
+        folder = self._get_result_folder('')
+        name = 'build_manifest.json'
+        return get_filepath(folder, name)
+
+    def get_indicator_journal_file(self, polarization: str):
+        folder = self.get_journal_folder()
+        name = f'indicators_{polarization}.jsonl'
+        return get_filepath(folder, name)
+
+    def get_profile_report_file(self, extension: str):
+        folder = self.get_profile_folder()
+        name = f'stage_report.{extension}'
+        return get_filepath(folder, name)
+
+    def get_cprofile_file(self):
+        folder = self.get_profile_folder()
+        name = 'pipeline.prof'
+        return get_filepath(folder, name)
+
+    def get_catalog_file(self, name: str):
+        folder = self.get_catalog_folder()
+        return get_filepath(folder, f'{name}.json')
+
     def get_reprojected_classified_file(self):
         folder = self.get_classified_folder()
         name = 'classified_reprojected.tif'
         return get_filepath(folder, name)
 
     def get_by_polarisation_from_folder(self, folder):
-        all_files = get_files_from_folder(folder)
+        # sorted by name (starts with the date), so the bands of a cube match the order of the reference timeseries
+        all_files = sorted(get_files_from_folder(folder))
         vv = []
         vh = []
         for f in all_files:
@@ -138,7 +193,18 @@ class FilepathProvider:
 
     def get_input_mm_files_by_polarisation(self):
         orig_mm_folder = self.get_sig0_mm_folder()
-        return self.get_by_polarisation_from_folder(orig_mm_folder)
+        if not self.use_catalog:
+            return self.get_by_polarisation_from_folder(orig_mm_folder)
+        catalog = self.get_mm_catalog()
+        return {polarization: catalog.get_paths(polarization=polarization) for polarization in ['VV', 'VH']}
+
+    def get_mm_catalog(self) -> RasterCatalog:
+        return get_catalog(self.get_sig0_mm_folder(), self.get_catalog_file('sig0_monthly_mean'))
+
+    def get_tif_info(self, path: str) -> TifInfo:
+        # monthly means from the catalog, everything else is opened
+        tif_info = self.get_mm_catalog().get_tif_info(path) if self.use_catalog else None
+        return tif_info or TifInfo(path)
 
 
 def get_files_from_folder(folder: str, ext: str = None):
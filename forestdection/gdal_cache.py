@@ -0,0 +1,64 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from osgeo import gdal
+
+
+class DatasetCache:
+    max_size = 64
+
+    def __init__(self, max_size: int = None):
+        if max_size:
+            self.max_size = max_size
+        self.datasets = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.pid = os.getpid()
+
+    def open(self, path: str) -> gdal.Dataset:
+        # Read only handles, datasets which are written must be closed here first (see close)
+        with self.lock:
+            self._check_process()
+            if path in self.datasets:
+                self.hits += 1
+                self.datasets.move_to_end(path)
+                return self.datasets[path]
+
+            self.misses += 1
+            ds = gdal.Open(path)
+            if ds is None:
+                return ds
+            self.datasets[path] = ds
+            self._evict()
+            return ds
+
+    def close(self, path: str):
+        with self.lock:
+            self.datasets.pop(path, None)
+
+    def close_all(self):
+        with self.lock:
+            self.datasets.clear()
+
+    def set_max_size(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def get_stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'open': len(self.datasets), 'max_size': self.max_size}
+
+    def _evict(self):
+        while len(self.datasets) > self.max_size:
+            self.datasets.popitem(last=False)
+
+    def _check_process(self):
+        # GDAL handles must not be shared with forked worker processes, every process opens its own
+        if os.getpid() != self.pid:
+            self.datasets = OrderedDict()
+            self.pid = os.getpid()
+
+
+dataset_cache = DatasetCache()
@@ -1,83 +1,222 @@
 import csv
-from typing import List, Tuple, Optional
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from math import gcd
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from typing import List, Tuple, Optional, Callable
 
 import matplotlib.pyplot as plt
 import numpy as np
-from osgeo import gdal, gdalconst
+from osgeo import gdal, gdalconst, ogr, osr
 
 from forestdection.domain import Timeseries, RasterCube, TifInfo
-from forestdection.filepath import FilepathProvider
+from forestdection.filepath import FilepathProvider, get_date_from_filename, get_filename_from_path
+from forestdection.gdal_cache import dataset_cache
+from forestdection.profiling import profiler
 
 
 class DeEnCoder:
+    # Output tifs are Float32 anyway, float64 would only double the memory per cube
+    dtype = np.float32
+    profiler = profiler
 
-    def default_decoder(self, data: np.array, factor: int = None, nodata=None):
+    def __init__(self, dtype=None):
+        if dtype:
+            self.dtype = dtype
+
+    def get_itemsize(self) -> int:
+        return np.dtype(self.dtype).itemsize
+
+    def default_decoder(self, data: np.array, factor: int = None, nodata=None, out: np.array = None):
         if not factor:
             factor = 100
-        if not nodata:
-            nodata = -9999
-
-        dataf = data.astype(float)
-        del data
-        dataf[dataf == nodata] = np.nan
-        return dataf / factor
+        if nodata is None:
+            nodata = -9999  # 0 is a valid nodata, e.g. of the HRL
+
+        # Decodes into out (e.g. a band slice of a preallocated cube) or into one new array, then works in place
+        with self.profiler.stage('decode'):
+            nodata_mask = data == nodata
+            if out is None:
+                out = data.astype(self.dtype)
+            else:
+                out[...] = data
+            del data
+            out[nodata_mask] = np.nan
+            out /= factor
+        return out
 
     def default_encoder(self, data: np.array, factor: int = None, nodata=None):
         if not factor:
             factor = 100
-        if not nodata:
+        if nodata is None:
             nodata = -9999
 
-        dataf = data.astype(float)
-        del data
-        dataf[np.isnan(dataf)] = nodata
-        return dataf * factor
+        with self.profiler.stage('encode'):
+            dataf = data.astype(self.dtype)  # the only copy, data stays untouched
+            del data
+            nodata_mask = np.isnan(dataf)
+            dataf *= factor
+            dataf[nodata_mask] = nodata  # after scaling, so nodata is written as the decoder expects it (was nodata * factor)
+        return dataf
 
 
 class RasterSegmenter:
     # TODO set from config
-    # Do not increase if used with current setup! Max!
+    # Upper bound of the window size if no memory budget is given, aligned to the block layout of the inputs
     col_size = 2000
     row_size = 2000
+    # Bytes one cube may use (raw reads, decoded bands and the stacked cube), derives the largest safe window
+    memory_budget = None
+    align_to_blocks = True
+    # Files of one cube read concurrently, keeps several requests outstanding on high latency storage, 1 ... one after another
+    read_threads = 1
+    # Block size of the tiled tifs the cubes are written to, windows cover whole output blocks,
+    # so a flushed window never leaves a partially written compressed block behind
+    output_block_size = None
     de_en_coder = DeEnCoder()
+    dataset_cache = dataset_cache
+    profiler = profiler
+
+    def __init__(self, col_size: int = None, row_size: int = None, memory_budget: int = None, read_threads: int = None,
+                 output_block_size: int = None):
+        if col_size:
+            self.col_size = col_size
+        if row_size:
+            self.row_size = row_size
+        if memory_budget:
+            self.memory_budget = memory_budget
+        if read_threads:
+            self.read_threads = read_threads
+        if output_block_size:
+            self.output_block_size = output_block_size
+        self.windows = None
+        self.window_idx = 0
+
+    def get_windows(self, input_paths: List[str]) -> List[Tuple[int, int, int, int]]:
+        # Plans the complete tile grid up front as (col_off, row_off, col_size, row_size), row by row
+        ds: gdal.Dataset = self.dataset_cache.open(input_paths[0])
+        size_x, size_y = ds.RasterXSize, ds.RasterYSize
+        del ds
+        window_col_size, window_row_size = self.get_window_size(input_paths)
+        return self.get_grid(size_x, size_y, window_col_size, window_row_size)
+
+    def get_grid(self, size_x: int, size_y: int, window_col_size: int = None, window_row_size: int = None) -> List[Tuple[int, int, int, int]]:
+        window_col_size = window_col_size if window_col_size else self.col_size
+        window_row_size = window_row_size if window_row_size else self.row_size
+
+        windows = []
+        for row_off in range(0, size_y, window_row_size):
+            for col_off in range(0, size_x, window_col_size):
+                # Ensure bbox is inside raster
+                col_size = min(window_col_size, size_x - col_off)
+                row_size = min(window_row_size, size_y - row_off)
+                windows.append((col_off, row_off, col_size, row_size))
+        return windows
+
+    def get_window_size(self, input_paths: List[str]) -> Tuple[int, int]:
+        if not self.align_to_blocks and not self.memory_budget and not self.output_block_size:
+            return self.col_size, self.row_size
+        return self.get_window_size_by_layout(*self.get_block_layout(input_paths))
+
+    def get_window_size_by_layout(self, block_x: int, block_y: int, size_x: int, bytes_per_pixel: int) -> Tuple[int, int]:
+        # At most col_size x row_size pixels or memory_budget bytes, aligned to the blocks, see get_block_layout
+        if self.memory_budget:
+            max_pixels = max(1, self.memory_budget // bytes_per_pixel)
+            col_size = int(np.sqrt(max_pixels))
+        else:
+            max_pixels = self.col_size * self.row_size
+            col_size = self.col_size
 
-    def __init__(self):
-        self.col_off = 0
-        self.row_off = 0
-
-    def get_next_cube(self, input_paths: List[str], decoder_factor: float = None, decoder_nodata=None) -> Optional[RasterCube]:
-        cube = []
+        if not self.align_to_blocks and not self.output_block_size:
+            return min(col_size, size_x), max(1, max_pixels // col_size)
+
+        if block_x >= size_x:
+            # Striped tif, windows over the full width do not decompress a strip once per column window
+            col_size = size_x
+        col_size = max(block_x, min(col_size, size_x) // block_x * block_x)
+        row_size = max(block_y, max_pixels // col_size // block_y * block_y)
+        return col_size, row_size
+
+    def get_block_layout(self, input_paths: List[str]) -> Tuple[int, int, int, int]:
+        # Smallest block which is a multiple of the blocks of all inputs (and the output blocks) and the bytes per pixel of one cube
+        # Overviews are not used, indicators are always calculated on the full resolution
+        block_x, block_y = 1, 1
+        size_x, size_y = 0, 0
+        bytes_per_pixel = 0
+        decoded_size = self.de_en_coder.get_itemsize()
         for path in input_paths:
-            ds: gdal.Dataset = gdal.Open(path)
+            ds: gdal.Dataset = self.dataset_cache.open(path)
+            band = ds.GetRasterBand(1)
+            x, y = band.GetBlockSize()
+            size_x, size_y = ds.RasterXSize, ds.RasterYSize
+            block_x = min(_lcm(block_x, x), size_x)
+            block_y = min(_lcm(block_y, y), size_y)
+            # raw read and its decoded band in the preallocated cube
+            bytes_per_pixel += gdal.GetDataTypeSize(band.DataType) // 8 + decoded_size
+            del band
+            del ds
+        block_x, block_y = self.align_to_output_blocks(block_x, block_y, size_x, size_y)
+        return block_x, block_y, size_x, bytes_per_pixel
 
-            # Check there is some part of the raster left
-            if self.col_off >= ds.RasterXSize:
-                self.col_off = 0
-                self.row_off += self.row_size
-                if self.row_off >= ds.RasterYSize:
-                    break
+    def align_to_output_blocks(self, block_x: int, block_y: int, size_x: int, size_y: int) -> Tuple[int, int]:
+        if self.output_block_size:
+            block_x = min(_lcm(block_x, self.output_block_size), size_x)
+            block_y = min(_lcm(block_y, self.output_block_size), size_y)
+        return block_x, block_y
 
-            # Ensure bbox is inside raster
-            col_size = self.col_size
-            row_size = self.row_size
-            if self.col_off + self.col_size >= ds.RasterXSize:
-                col_size = ds.RasterXSize - self.col_off
-            if self.row_off + self.row_size >= ds.RasterYSize:
-                row_size = ds.RasterYSize - self.row_off
-
-            # Get data
-            c = np.array(ds.GetRasterBand(1).ReadAsArray(self.col_off, self.row_off, col_size, row_size))
-            del ds
-            cube.append(self.de_en_coder.default_decoder(c, decoder_factor, decoder_nodata))
+    def get_next_cube(self, input_paths: List[str], decoder_factor: float = None, decoder_nodata=None) -> Optional[RasterCube]:
+        if not input_paths:
+            return None
+        if self.windows is None:
+            self.windows = self.get_windows(input_paths)
 
-        if not cube:
+        # Check there is some part of the raster left
+        if self.window_idx >= len(self.windows):
             return None
 
-        # Order is important! First assign col_off to raster_cube and then increase it for the next cube
-        raster_cube = RasterCube(self.col_off, self.row_off, np.dstack(cube))
-        self.col_off += self.col_size
+        raster_cube = self.get_cube(input_paths, self.windows[self.window_idx], decoder_factor, decoder_nodata)
+        self.window_idx += 1
         return raster_cube
 
+    def get_cube(self, input_paths: List[str], window: Tuple[int, int, int, int], decoder_factor: float = None, decoder_nodata=None) -> RasterCube:
+        col_off, row_off, col_size, row_size = window
+        # Every band is decoded straight into its slice, no list of bands and no dstack copy
+        with self.profiler.stage('read_cube'):
+            cube = np.empty((row_size, col_size, len(input_paths)), dtype=self.de_en_coder.dtype)
+            read_band = partial(self._read_band, window=window, decoder_factor=decoder_factor, decoder_nodata=decoder_nodata)
+            if self.read_threads <= 1 or len(set(input_paths)) < len(input_paths):  # a handle must not be read by two threads
+                for idx, path in enumerate(input_paths):
+                    read_band(path, cube[:, :, idx])
+            else:
+                # every file has its own dataset handle and slice, GDAL releases the GIL while reading
+                with ThreadPoolExecutor(max_workers=min(self.read_threads, len(input_paths))) as executor:
+                    list(executor.map(read_band, input_paths, [cube[:, :, idx] for idx in range(len(input_paths))]))
+        return RasterCube(col_off, row_off, cube)
+
+    def _read_band(self, path: str, out: np.array, window: Tuple[int, int, int, int], decoder_factor: float = None, decoder_nodata=None):
+        col_off, row_off, col_size, row_size = window
+        with self.profiler.stage('gdal_read') as stage:
+            ds: gdal.Dataset = self.dataset_cache.open(path)
+            c = ds.GetRasterBand(1).ReadAsArray(col_off, row_off, col_size, row_size)
+            stage.add_bytes(c.nbytes)
+        del ds
+        self.de_en_coder.default_decoder(c, decoder_factor, decoder_nodata, out=out)
+
+    def get_empty_raster(self, windows: List[Tuple[int, int, int, int]], dtype=None) -> np.array:
+        cols = max(col_off + col_size for col_off, _, col_size, _ in windows)
+        rows = max(row_off + row_size for _, row_off, _, row_size in windows)
+        raster = np.empty((rows, cols), dtype=dtype if dtype else self.de_en_coder.dtype)
+        raster[:] = np.nan
+        return raster
+
+    def insert_cube(self, raster: np.array, cube: RasterCube):
+        col_min, col_max, row_min, row_max = cube.get_extend()
+        raster[row_min:row_max, col_min:col_max] = cube.data
+
     def get_raster_from_cubes(self, cubes: List[RasterCube]) -> np.array:
         cols, rows = self._get_size_of_all_cubes(cubes)
         raster = np.empty((rows, cols), dtype=cubes[0].data.dtype)
@@ -100,10 +239,207 @@ class RasterSegmenter:
         return self.get_raster_from_cubes(cubes)
 
 
+class TimeseriesCube:
+    # Decoded monthly means of one polarization as one (rows, cols, time) .npy file, the time vector of a pixel is contiguous
+    # The sidecar json holds the dates, the input paths and the georeferencing (TifInfo)
+    # Can be used instead of the list of monthly mean paths, with its own get_windows and get_cube
+    version = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta_path = path.replace('.npy', '.json')
+        self.data = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path) and os.path.isfile(self.meta_path)
+
+    def ingest(self, input_paths: List[str], decoder_factor: float = None, decoder_nodata=None):
+        raster_segmenter = RasterSegmenter()
+        tif_info = TifInfo(input_paths[0])
+        data = np.lib.format.open_memmap(self.path, mode='w+', dtype=raster_segmenter.de_en_coder.dtype,
+                                         shape=(tif_info.size_y, tif_info.size_x, len(input_paths)))
+        for window in raster_segmenter.get_windows(input_paths):
+            cube = raster_segmenter.get_cube(input_paths, window, decoder_factor, decoder_nodata)
+            col_min, col_max, row_min, row_max = cube.get_extend()
+            data[row_min:row_max, col_min:col_max, :] = cube.data
+        data.flush()
+        del data
+
+        meta = {'dates': [get_date_from_filename(get_filename_from_path(path)) for path in input_paths],
+                'paths': input_paths, 'tif_info': tif_info.to_dict()}
+        with open(self.meta_path, 'w') as file:
+            json.dump(meta, file)
+        self.data = None
+
+    def get_meta(self) -> dict:
+        with open(self.meta_path, 'r') as file:
+            return json.load(file)
+
+    def get_tif_info(self) -> TifInfo:
+        return TifInfo.from_dict(self.get_meta()['tif_info'])
+
+    def get_windows(self, raster_segmenter: RasterSegmenter) -> List[Tuple[int, int, int, int]]:
+        # Full width row bands are contiguous in the file, sized by the window size or memory budget of raster_segmenter
+        # and aligned to its output blocks, a pixel is its decoded time vector
+        data = self._get_data()
+        rows, cols, size = data.shape
+        block_x, block_y = raster_segmenter.align_to_output_blocks(cols, 1, cols, rows)
+        col_size, row_size = raster_segmenter.get_window_size_by_layout(block_x, block_y, cols, size * data.dtype.itemsize)
+        return raster_segmenter.get_grid(cols, rows, col_size, row_size)
+
+    def get_cube(self, window: Tuple[int, int, int, int]) -> RasterCube:
+        # Zero copy view on the memory map
+        col_off, row_off, col_size, row_size = window
+        return RasterCube(col_off, row_off, self._get_data()[row_off:row_off + row_size, col_off:col_off + col_size, :])
+
+    def _get_data(self) -> np.array:
+        if self.data is None:
+            self.data = np.lib.format.open_memmap(self.path, mode='r')
+        return self.data
+
+    def __getstate__(self):
+        # Worker processes open their own memory map
+        return {'path': self.path, 'meta_path': self.meta_path, 'data': None}
+
+
+class CubePrefetcher:
+    # Iterates the cubes of windows, a background thread reads and decodes up to depth cubes ahead of the consumer
+    # GDAL releases the GIL while reading, so the reads overlap with the numpy work on the current cube
+    # In memory are at most depth queued cubes, the one being read and the one being processed
+    depth = 1
+
+    def __init__(self, get_cube: Callable[[Tuple[int, int, int, int]], RasterCube], windows: List[Tuple[int, int, int, int]],
+                 depth: int = None):
+        # get_cube ... reads the cube of a window, e.g. partial(RasterSegmenter.get_cube, input_paths) or TimeseriesCube.get_cube
+        if depth:
+            self.depth = depth
+        self.get_cube = get_cube
+        self.windows = windows
+        self.queue = Queue(maxsize=self.depth)
+        self.stop_event = Event()
+        self.thread = None
+        # consumer side metrics: cubes which were not read yet when they were needed and the time spent waiting for them
+        self.cubes = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+
+    def __iter__(self):
+        self.start()
+        try:
+            for _ in self.windows:
+                try:
+                    cube, error = self.queue.get_nowait()
+                except Empty:
+                    start = time.perf_counter()
+                    cube, error = self.queue.get()
+                    self.stalls += 1
+                    self.stall_seconds += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                self.cubes += 1
+                yield cube
+        finally:
+            self.close()
+
+    def start(self):
+        self.thread = Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Also stops the reader if the consumer stops early, queued cubes are dropped
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()  # a blocked put gives up within its timeout
+            self.thread = None
+        self._drain()
+
+    def get_stats(self) -> dict:
+        return {'depth': self.depth, 'cubes': self.cubes, 'stalls': self.stalls, 'stall_seconds': round(self.stall_seconds, 3)}
+
+    def _read(self):
+        for window in self.windows:
+            if self.stop_event.is_set():
+                return
+            try:
+                item = (self.get_cube(window), None)
+            except Exception as error:
+                item = (None, error)  # raised in the consumer
+            self._put(item)
+            if item[1] is not None:
+                return
+
+    def _put(self, item: tuple):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _drain(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                return
+
+
+def _lcm(a: int, b: int) -> int:
+    return a * b // gcd(a, b)
+
+
+class TifProfile:
+    # Creation options of an output tif, factor and nodata are used to encode / decode its values
+
+    def __init__(self, data_type: str = 'Float32', tiled: bool = True, block_size: int = 256, compress: str = 'DEFLATE',
+                 predictor: int = None, bigtiff: str = 'IF_SAFER', overviews: List[int] = None, factor: float = None, nodata=None):
+        self.data_type = data_type
+        self.tiled = tiled
+        self.block_size = block_size
+        self.compress = compress
+        self.predictor = predictor
+        self.bigtiff = bigtiff
+        self.overviews = overviews if overviews is not None else []
+        self.factor = factor
+        self.nodata = nodata
+
+    def get_creation_options(self) -> List[str]:
+        options = []
+        if self.tiled:
+            options += ['TILED=YES', f'BLOCKXSIZE={self.block_size}', f'BLOCKYSIZE={self.block_size}']
+        if self.compress:
+            options.append(f'COMPRESS={self.compress}')
+            if self.predictor:
+                options.append(f'PREDICTOR={self.predictor}')  # 2 ... integer, 3 ... floating point
+        if self.bigtiff:
+            options.append(f'BIGTIFF={self.bigtiff}')
+        return options
+
+    def is_integer(self) -> bool:
+        return self.data_type not in ['Float32', 'Float64']
+
+    def get_overview_resampling(self) -> str:
+        return 'NEAREST' if self.is_integer() else 'AVERAGE'
+
+    def get_params(self) -> dict:
+        return dict(vars(self))
+
+
 class TifReaderWriter:
 
     filepath_provider = FilepathProvider()
     de_en_coder = DeEnCoder()
+    dataset_cache = dataset_cache
+    profiler = profiler
+    profiles = {
+        'default': TifProfile(tiled=False, compress=None, bigtiff=None),
+        'indicator': TifProfile('Float32', predictor=3, factor=1, nodata=-9999),
+        'indicator_int16': TifProfile('Int16', predictor=2, factor=100, nodata=-9999),
+        'classified': TifProfile('Byte', predictor=2, overviews=[2, 4, 8, 16], factor=1, nodata=255),
+    }
+
+    def get_profile(self, name: str) -> TifProfile:
+        return self.profiles[name]
 
     def write_rmsd_tif(self, rmsd: np.array, output_path: str, source: TifInfo, encoder_factor: float = None, encoder_nodata=None):
         return self.write_tif(rmsd, output_path, source, encoder_factor, encoder_nodata)
@@ -111,38 +447,75 @@ class TifReaderWriter:
     def write_pearson_tif(self, pearson: np.array, output_path: str, source: TifInfo, encoder_factor: float = None, encoder_nodata=None):
         self.write_tif(pearson, output_path, source, encoder_factor, encoder_nodata)
 
-    def write_tif(self, data: np.array, output_path: str, tif_info: TifInfo, encoder_factor: float = None, encoder_nodata=None):
+    def write_tif(self, data: np.array, output_path: str, tif_info: TifInfo, encoder_factor: float = None, encoder_nodata=None,
+                  profile: TifProfile = None):
+        profile = profile if profile else self.get_profile('default')
+        data = self.encode(data, profile, encoder_factor, encoder_nodata)
+        out_dataset = self.create_tif(output_path, tif_info, profile)
+
+        # Write data
+        with self.profiler.stage('write_tif'):
+            outband = out_dataset.GetRasterBand(1)
+            outband.WriteArray(data)
+            outband.FlushCache()
+        self.build_overviews(out_dataset, profile)
+
+        return out_dataset
+
+    def encode(self, data: np.array, profile: TifProfile, encoder_factor: float = None, encoder_nodata=None) -> np.array:
+        encoder_factor = encoder_factor if encoder_factor else profile.factor
+        encoder_nodata = encoder_nodata if encoder_nodata is not None else profile.nodata
         data = self.de_en_coder.default_encoder(data, encoder_factor, encoder_nodata)
+        if profile.is_integer():
+            np.rint(data, out=data)  # WriteArray would truncate
+        return data
+
+    def quantize(self, data: np.array, profile: TifProfile) -> np.array:
+        # The values as they are read back from a tif written with profile, e.g. rounded to 1 / factor for integer profiles
+        return self.de_en_coder.default_decoder(self.encode(data, profile), profile.factor, profile.nodata)
+
+    def create_tif(self, output_path: str, tif_info: TifInfo, profile: TifProfile = None) -> gdal.Dataset:
+        profile = profile if profile else self.get_profile('default')
+        # A cached read handle would not see the new content
+        self.dataset_cache.close(output_path)
 
         # Create Driver
         driver = gdal.GetDriverByName('GTiff')
-        # TODO check datatype (origin sig0 mm sixteen bit signed integer > is float 32 enough or do we need float64?)
-        out_dataset = driver.Create(output_path, tif_info.size_x, tif_info.size_y, 1, gdal.GDT_Float32)
-        out_dataset.SetGeoTransform((tif_info.origin_x, tif_info.pixel_width, 0, tif_info.origin_y, 0, tif_info.pixel_height))
+        out_dataset = driver.Create(output_path, tif_info.size_x, tif_info.size_y, 1, gdal.GetDataTypeByName(profile.data_type),
+                                    options=profile.get_creation_options())
+        out_dataset.SetGeoTransform(tif_info.get_geo_transform())
 
         # set Coordinate system
         out_dataset.SetProjection(tif_info.wkt_projection)
 
-        # Write data
+        # nodata and scale, so other tools show the decoded values
         outband = out_dataset.GetRasterBand(1)
-        outband.WriteArray(data)
-        outband.FlushCache()
-
+        if profile.nodata is not None:
+            outband.SetNoDataValue(profile.nodata)
+        if profile.factor and profile.factor != 1:
+            outband.SetScale(1 / profile.factor)
         return out_dataset
 
+    def build_overviews(self, out_dataset: gdal.Dataset, profile: TifProfile):
+        # internal overviews, out_dataset has to be open for writing
+        if profile.overviews:
+            with self.profiler.stage('build_overviews'):
+                out_dataset.BuildOverviews(profile.get_overview_resampling(), profile.overviews)
+
     def reproject_tif(self, src_filename: str, dst_filename: str, match_filename: str):
         # Source
-        src = gdal.Open(src_filename, gdalconst.GA_ReadOnly)
+        src = self.dataset_cache.open(src_filename)
         src_proj = src.GetProjection()
 
         # We want a section of source that matches this:
-        match_ds = gdal.Open(match_filename, gdalconst.GA_ReadOnly)
+        match_ds = self.dataset_cache.open(match_filename)
         match_proj = match_ds.GetProjection()
         match_geotrans = match_ds.GetGeoTransform()
         wide = match_ds.RasterXSize
         high = match_ds.RasterYSize
 
         # Output / destination
+        self.dataset_cache.close(dst_filename)
         dst = gdal.GetDriverByName('GTiff').Create(dst_filename, wide, high, 1, gdalconst.GDT_Float32)
         dst.SetGeoTransform(match_geotrans)
         dst.SetProjection(match_proj)
@@ -152,11 +525,135 @@ class TifReaderWriter:
 
         del dst  # Flush
 
+    def read_tif_window(self, input_path: str, window: Tuple[int, int, int, int], decoder_factor: float = None, decoder_nodata=None):
+        col_off, row_off, col_size, row_size = window
+        with self.profiler.stage('gdal_read') as stage:
+            ds = self.dataset_cache.open(input_path)
+            data = ds.GetRasterBand(1).ReadAsArray(col_off, row_off, col_size, row_size)
+            stage.add_bytes(data.nbytes)
+        return self.de_en_coder.default_decoder(data, decoder_factor, decoder_nodata)
+
+    def rasterize_shape(self, shape_path: str, tif_info: TifInfo) -> Tuple[np.array, Tuple[int, int, int, int]]:
+        # Mask of the shape polygons on the grid of tif_info, pixel centers inside like a gdalwarp cutline
+        # Only the window of the layer extent is rasterized (the full grid if the shape has another srs), returns mask and window
+        shape_ds = ogr.Open(shape_path)
+        layer = shape_ds.GetLayer()
+        col_off, row_off, col_size, row_size = window = self.get_extent_window(layer, tif_info)
+        mask_ds = gdal.GetDriverByName('MEM').Create('', col_size, row_size, 1, gdal.GDT_Byte)
+        mask_ds.SetGeoTransform((tif_info.origin_x + col_off * tif_info.pixel_width, tif_info.pixel_width, 0,
+                                 tif_info.origin_y + row_off * tif_info.pixel_height, 0, tif_info.pixel_height))
+        mask_ds.SetProjection(tif_info.wkt_projection)
+
+        gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+        mask = mask_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+        del layer
+        del shape_ds
+        del mask_ds
+        return mask, window
+
+    def get_extent_window(self, layer: ogr.Layer, tif_info: TifInfo) -> Tuple[int, int, int, int]:
+        # Pixels of tif_info touched by the extent of the layer, clipped to the grid
+        full_window = (0, 0, tif_info.size_x, tif_info.size_y)
+        layer_srs = layer.GetSpatialRef()
+        if layer_srs is not None and tif_info.wkt_projection and not layer_srs.IsSame(osr.SpatialReference(wkt=tif_info.wkt_projection)):
+            return full_window  # RasterizeLayer reprojects the polygons, their extent is not in the grid srs
+
+        min_x, max_x, min_y, max_y = layer.GetExtent()
+        cols = sorted([(min_x - tif_info.origin_x) / tif_info.pixel_width, (max_x - tif_info.origin_x) / tif_info.pixel_width])
+        rows = sorted([(min_y - tif_info.origin_y) / tif_info.pixel_height, (max_y - tif_info.origin_y) / tif_info.pixel_height])
+        col_min, col_max = max(0, int(np.floor(cols[0]))), min(tif_info.size_x, int(np.ceil(cols[1])))
+        row_min, row_max = max(0, int(np.floor(rows[0]))), min(tif_info.size_y, int(np.ceil(rows[1])))
+        if col_min >= col_max or row_min >= row_max:
+            return full_window  # outside, the empty mask is reported by the caller
+        return col_min, row_min, col_max - col_min, row_max - row_min
+
     def read_tif(self, input_path: str, decoder_factor: float = None, decoder_nodata=None):
-        ds = gdal.Open(input_path)
-        data = np.array(ds.GetRasterBand(1).ReadAsArray())
+        with self.profiler.stage('gdal_read') as stage:
+            ds = self.dataset_cache.open(input_path)
+            data = ds.GetRasterBand(1).ReadAsArray()
+            stage.add_bytes(data.nbytes)
+        return self.de_en_coder.default_decoder(data, decoder_factor, decoder_nodata)
+
+
+class TifWindowWriter:
+    # Keeps the output tif open and writes every cube into its window, so only one cube has to be in memory
+    tif_reader_writer = TifReaderWriter()
+
+    def __init__(self, output_path: str, tif_info: TifInfo, encoder_factor: float = None, encoder_nodata=None, profile: TifProfile = None,
+                 resume: bool = False):
+        # resume ... keep the windows already written into an existing output_path, see WindowJournal
+        self.output_path = output_path
+        self.encoder_factor = encoder_factor
+        self.encoder_nodata = encoder_nodata
+        self.profile = profile if profile else self.tif_reader_writer.get_profile('default')
+        if resume and os.path.isfile(output_path):
+            self.tif_reader_writer.dataset_cache.close(output_path)
+            self.out_dataset = gdal.Open(output_path, gdal.GA_Update)
+        else:
+            self.out_dataset = self.tif_reader_writer.create_tif(output_path, tif_info, self.profile)
+        self.outband = self.out_dataset.GetRasterBand(1)
+
+    def get_block_size(self) -> Optional[int]:
+        # None for striped tifs
+        return self.profile.block_size if self.profile.tiled else None
+
+    def write_cube(self, cube: RasterCube):
+        data = self.tif_reader_writer.encode(cube.data, self.profile, self.encoder_factor, self.encoder_nodata)
+        with self.tif_reader_writer.profiler.stage('write_tif'):
+            self.outband.WriteArray(data, cube.col_off, cube.row_off)
+
+    def flush(self):
+        # written windows are on disk, e.g. before they are added to a journal
+        self.outband.FlushCache()
+        self.out_dataset.FlushCache()
+
+    def close(self):
+        self.outband.FlushCache()
+        self.tif_reader_writer.build_overviews(self.out_dataset, self.profile)
+        self.outband = None
+        self.out_dataset = None  # Flush
+
+
+class WarpedTifReader:
+    # The source raster on the grid of tif_info as a warped VRT, only the read windows are warped, no intermediate file
+    # The VRT refers to the source handle, so the reader owns it instead of the dataset cache, which may close it, see close
+    resampling = gdalconst.GRA_NearestNeighbour  # classes must not be interpolated
+    nodata = 255  # outside of the source footprint, if the source has no nodata value
+    de_en_coder = DeEnCoder()
+    profiler = profiler
+
+    def __init__(self, src_path: str, tif_info: TifInfo, resampling=None):
+        self.src_path = src_path
+        self.tif_info = tif_info
+        if resampling is not None:
+            self.resampling = resampling
+        self.src_dataset = gdal.Open(src_path)
+        src_nodata = self.src_dataset.GetRasterBand(1).GetNoDataValue()
+        if src_nodata is not None:
+            self.nodata = src_nodata
+        self.dataset = self._get_warped_dataset(src_nodata)
+
+    def read_window(self, window: Tuple[int, int, int, int], decoder_factor: float = None, decoder_nodata=None) -> np.array:
+        # pixels without source data are decoded to nan
+        col_off, row_off, col_size, row_size = window
+        with self.profiler.stage('warped_read') as stage:
+            data = self.dataset.GetRasterBand(1).ReadAsArray(col_off, row_off, col_size, row_size)
+            stage.add_bytes(data.nbytes)
+        decoder_nodata = decoder_nodata if decoder_nodata is not None else self.nodata
         return self.de_en_coder.default_decoder(data, decoder_factor, decoder_nodata)
 
+    def close(self):
+        self.dataset = None  # the VRT before its source
+        self.src_dataset = None
+
+    def _get_warped_dataset(self, src_nodata) -> gdal.Dataset:
+        tif_info = self.tif_info
+        min_y = tif_info.origin_y + tif_info.size_y * tif_info.pixel_height
+        max_x = tif_info.origin_x + tif_info.size_x * tif_info.pixel_width
+        return gdal.Warp('', self.src_dataset, format='VRT', outputBounds=(tif_info.origin_x, min_y, max_x, tif_info.origin_y),
+                         width=tif_info.size_x, height=tif_info.size_y, dstSRS=tif_info.wkt_projection, resampleAlg=self.resampling,
+                         srcNodata=src_nodata, dstNodata=self.nodata)
+
 
 class Plotter:
 
@@ -1,11 +1,14 @@
 import os
-from typing import List
+from typing import List, Dict, Tuple
 import numpy as np
 
-from forestdection.filepath import FilepathProvider, FilenameProvider, get_filepath
-from forestdection.service import IndicatorCalculation, ReferenceUtils, ForestClassification, AccuracyMeasure
-from forestdection.io2 import CsvReaderWriter, TifReaderWriter, Plotter
+from forestdection.filepath import FilepathProvider, FilenameProvider, get_filepath, get_date_from_filename, get_filename_from_path
+from forestdection.service import IndicatorCalculation, ReferenceUtils, ForestClassification, AccuracyMeasure, IndicatorStatistics, \
+    ComparisonUtils
+from forestdection.io2 import CsvReaderWriter, TifReaderWriter, Plotter, TifWindowWriter, TimeseriesCube
 from forestdection.domain import Timeseries, TifInfo, Indicators
+from forestdection.build_cache import BuildCache, WindowJournal, get_shape_paths
+from forestdection.profiling import profiler
 
 
 class Main:
@@ -19,6 +22,15 @@ class Main:
     tif_reader_writer = TifReaderWriter()
     reference_utils = ReferenceUtils()
     plotter = Plotter()
+    comparison_utils = ComparisonUtils()
+    profiler = profiler
+    indicator_types = ['rmsd', 'pearson']
+    build_cache = None
+    use_timeseries_cubes = False
+    indicator_profile = 'indicator'
+    classified_profile = 'classified'
+    profile_stages = False  # stage timings, read bytes and RSS growth of a run, see write_profile_report
+    profile_cprofile = False
 
     def get_all_reference_timeseries(self, build: bool = False, plot: bool = False) -> List[Timeseries]:
         shape_paths = self.filepath_provider.get_input_shape_files_by_forest_type()
@@ -26,16 +38,41 @@ class Main:
 
         all_timeseries = []
         for forest_type, shape_path in shape_paths.items():
+            reference_mask = None  # rasterized on first use, once for all polarizations (same grid)
             for polarization, mm_paths in all_mm_paths.items():
                 timeseries_path = self.filepath_provider.get_timeseries_file(polarization, forest_type)
 
-                if not os.path.isfile(timeseries_path) or build:
-                    timeseries = self.reference_utils.get_reference_timeseries(forest_type, shape_path, mm_paths)
-                    self.csv_read_writer.write_timeseries(timeseries, timeseries_path)
+                build_cache = self._get_build_cache()
+                timeseries_key = build_cache.get_key(get_shape_paths(shape_path) + mm_paths, version=self.reference_utils.version)
+
+                if build or not os.path.isfile(timeseries_path):
+                    reference_mask = reference_mask or self.reference_utils.get_reference_mask(shape_path, mm_paths[0])
+                    timeseries = self.reference_utils.get_reference_timeseries(forest_type, shape_path, mm_paths, reference_mask)
+                elif build_cache.is_valid([timeseries_path], timeseries_key):
+                    timeseries = self.csv_read_writer.read_timeseries(timeseries_path)
                 else:
                     timeseries = self.csv_read_writer.read_timeseries(timeseries_path)
+                    known_paths = [p for p in mm_paths if get_date_from_filename(get_filename_from_path(p)) in timeseries.dates]
+                    missing_paths = [p for p in mm_paths if p not in known_paths]
+                    known_key = build_cache.get_key(get_shape_paths(shape_path) + known_paths, version=self.reference_utils.version)
+                    if missing_paths and build_cache.is_valid([timeseries_path], known_key):
+                        # only new monthly means, just their reference values are calculated
+                        reference_mask = reference_mask or self.reference_utils.get_reference_mask(shape_path, mm_paths[0])
+                        missing_timeseries = self.reference_utils.get_reference_timeseries(forest_type, shape_path, missing_paths,
+                                                                                           reference_mask)
+                        timeseries.push_all(missing_timeseries.dates, missing_timeseries.sig0s)
+                        dates, sig0s = timeseries.get_sorted()
+                        timeseries = Timeseries(list(dates), list(sig0s))
+                    else:
+                        print(f'Inputs of {timeseries_path} changed')
+                        reference_mask = reference_mask or self.reference_utils.get_reference_mask(shape_path, mm_paths[0])
+                        timeseries = self.reference_utils.get_reference_timeseries(forest_type, shape_path, mm_paths, reference_mask)
+
+                if not build_cache.is_valid([timeseries_path], timeseries_key):
+                    self.csv_read_writer.write_timeseries(timeseries, timeseries_path)
+                    build_cache.update([timeseries_path], timeseries_key)
 
-                timeseries.set_description(polarization, forest_type)
+                timeseries.set_description(forest_type, polarization)
                 all_timeseries.append(timeseries)
 
         if plot:
@@ -44,67 +81,190 @@ class Main:
 
         return all_timeseries
 
-    def get_all_rmsd(self, build: bool = False) -> Indicators:
-        return self._get_indicator_for_all('rmsd', self.filepath_provider.get_rmsd_file, self.indicator_calculation.get_rmsd, build)
+    def get_all_indicators(self, build: bool = False) -> Indicators:
+        indicator_paths = self.build_all_indicators(build)
+        indicator_profile = self.tif_reader_writer.get_profile(self.indicator_profile)
+        indicators = Indicators(capacity=len(indicator_paths))
+        for (forest_type, polarization, indicator_type), indicator_path in indicator_paths.items():
+            print(f'\nLoading indicator path {indicator_path}')
+            indicator = self.tif_reader_writer.read_tif(indicator_path, decoder_factor=indicator_profile.factor,
+                                                        decoder_nodata=indicator_profile.nodata)
+            indicators.push(forest_type, polarization, indicator_type, indicator)
+        return indicators
+
+    def build_all_indicators(self, build: bool = False) -> Dict[Tuple[str, str, str], str]:
+        # Ensures all indicator tifs are up to date, returns their paths by (forest type, polarization, type)
+        all_reference_timeseries = self.get_all_reference_timeseries()
+        all_mm_paths = self.filepath_provider.get_input_mm_files_by_polarisation()
+        mm_tif_info = self._get_tif_info(all_mm_paths['VV'][0])
+
+        indicator_paths = {}
+        for reference_timeseries in all_reference_timeseries:
+            forest_type, polarization = reference_timeseries.forest_type, reference_timeseries.polarization
+            for indicator_type in self.indicator_types:
+                indicator_paths[(forest_type, polarization, indicator_type)] = \
+                    self.filepath_provider.get_indicator_file(indicator_type, polarization, forest_type)
+
+        indicator_key = self._get_indicator_key(all_reference_timeseries, all_mm_paths)
+        if build or not self._get_build_cache().is_valid(list(indicator_paths.values()), indicator_key):
+            print('Calculating all indicator tifs')
+            indicator_inputs = self.get_all_timeseries_cubes() if self.use_timeseries_cubes else all_mm_paths
+            # finished windows of an interrupted run with the same inputs are kept
+            journals = {polarization: WindowJournal(self.filepath_provider.get_indicator_journal_file(polarization), indicator_key)
+                        for polarization in all_mm_paths}
+            if build:
+                for journal in journals.values():
+                    journal.reset()
+            self.indicator_calculation.write_all_indicators(all_reference_timeseries, indicator_inputs, indicator_paths, mm_tif_info,
+                                                            profile=self.tif_reader_writer.get_profile(self.indicator_profile),
+                                                            journals=journals)
+            self._get_build_cache().update(list(indicator_paths.values()), indicator_key)
+            for journal in journals.values():
+                journal.reset()  # the build cache covers the complete tifs
+        return indicator_paths
+
+    def get_all_timeseries_cubes(self, build: bool = False) -> Dict[str, TimeseriesCube]:
+        # Monthly means ingested once per polarization into a memory mapped (rows, cols, time) cube
+        all_mm_paths = self.filepath_provider.get_input_mm_files_by_polarisation()
+        all_timeseries_cubes = {}
+        for polarization, mm_paths in all_mm_paths.items():
+            timeseries_cube = TimeseriesCube(self.filepath_provider.get_timeseries_cube_file(polarization))
+            cube_key = self._get_build_cache().get_key(mm_paths, {'dtype': str(self.tif_reader_writer.de_en_coder.dtype)},
+                                                       TimeseriesCube.version)
+            if build or not self._get_build_cache().is_valid([timeseries_cube.path, timeseries_cube.meta_path], cube_key):
+                print(f'Ingesting {polarization} monthly means into {timeseries_cube.path}')
+                timeseries_cube.ingest(mm_paths)
+                self._get_build_cache().update([timeseries_cube.path, timeseries_cube.meta_path], cube_key)
+            all_timeseries_cubes[polarization] = timeseries_cube
+        return all_timeseries_cubes
+
+    def update_indicators(self, build: bool = False):
+        # Folds only new monthly means into the per pixel statistics and regenerates all indicator tifs from them
+        # The statistics are recreated if the forest types or the reference values of folded months changed, build ... always
+        all_reference_timeseries = self.get_all_reference_timeseries()
+        all_mm_paths = self.filepath_provider.get_input_mm_files_by_polarisation()
+        mm_tif_info = self._get_tif_info(all_mm_paths['VV'][0])
+
+        for polarization, mm_paths in all_mm_paths.items():
+            reference_timeseries = [ts for ts in all_reference_timeseries if ts.polarization == polarization]
+            statistics = IndicatorStatistics(self.filepath_provider.get_statistics_folder(polarization))
+            if build or not statistics.is_valid(reference_timeseries, mm_paths, mm_tif_info.size_x, mm_tif_info.size_y):
+                print(f'Creating {polarization} statistics')
+                statistics.create([ts.forest_type for ts in reference_timeseries], mm_tif_info.size_x, mm_tif_info.size_y)
+
+            known_dates = statistics.get_dates()
+            for mm_path in mm_paths:
+                date = get_date_from_filename(get_filename_from_path(mm_path))
+                if date in known_dates:
+                    continue
+                print(f'Adding monthly mean {mm_path}')
+                statistics.add_month(mm_path, statistics.get_reference_values(reference_timeseries, date))
 
-    def get_all_pearson(self, build: bool = False) -> Indicators:
-        return self._get_indicator_for_all('pearson', self.filepath_provider.get_pearson_file, self.indicator_calculation.get_pearson, build)
+            print(f'Writing {polarization} indicator tifs from statistics')
+            indicator_profile = self.tif_reader_writer.get_profile(self.indicator_profile)
+            rmsd_writers = [TifWindowWriter(self.filepath_provider.get_rmsd_file(polarization, ts.forest_type), mm_tif_info, profile=indicator_profile)
+                            for ts in reference_timeseries]
+            pearson_writers = [TifWindowWriter(self.filepath_provider.get_pearson_file(polarization, ts.forest_type), mm_tif_info,
+                                               profile=indicator_profile) for ts in reference_timeseries]
+            statistics.write_indicators(reference_timeseries, [w.write_cube for w in rmsd_writers], [w.write_cube for w in pearson_writers])
+            for writer in rmsd_writers + pearson_writers:
+                writer.close()
 
-    def get_classified(self, build: bool = False) -> List[np.array]:
-        rmsd = self.get_all_rmsd()
-        pearson = self.get_all_pearson()
+        indicator_paths = [self.filepath_provider.get_indicator_file(indicator_type, ts.polarization, ts.forest_type)
+                           for ts in all_reference_timeseries for indicator_type in self.indicator_types]
+        self._get_build_cache().update(indicator_paths, self._get_indicator_key(all_reference_timeseries, all_mm_paths))
+
+    def get_classified(self, build: bool = False) -> np.array:
+        classified_path = self.build_classified(build)
+        print('Loading classified tif')
+        classified_profile = self.tif_reader_writer.get_profile(self.classified_profile)
+        return self.tif_reader_writer.read_tif(classified_path, decoder_factor=classified_profile.factor, decoder_nodata=classified_profile.nodata)
+
+    def build_classified(self, build: bool = False) -> str:
+        # Classified window by window straight from the indicator tifs, which are never loaded completely
+        indicator_paths = self.build_all_indicators()
         classified_path = self.filepath_provider.get_classified_file()
+        classified_profile = self.tif_reader_writer.get_profile(self.classified_profile)
+        classified_key = self._get_classified_key(indicator_paths)
 
-        if not os.path.isfile(classified_path) or build:
+        if build or not self._get_build_cache().is_valid([classified_path], classified_key):
             all_mm_paths = self.filepath_provider.get_input_mm_files_by_polarisation()
-            mm_tif_info = TifInfo(all_mm_paths['VV'][0])
+            mm_tif_info = self._get_tif_info(all_mm_paths['VV'][0])
 
             print('Calculating classification tif')
-            forest_class_raster = self.forest_classification.classify_forest(rmsd, pearson)
-            self.tif_reader_writer.write_tif(forest_class_raster, classified_path, mm_tif_info, encoder_factor=1, encoder_nodata=-9999)
-        else:
-            print('Loading classified tif')
-            forest_class_raster = self.tif_reader_writer.read_tif(classified_path, decoder_factor=1, decoder_nodata=-9999)
+            self.forest_classification.write_classified(indicator_paths, classified_path, mm_tif_info,
+                                                        self.tif_reader_writer.get_profile(self.indicator_profile), classified_profile)
+            self._get_build_cache().update([classified_path], classified_key)
+        return classified_path
 
-        return forest_class_raster
+    def get_mmu_classified(self, build: bool = False) -> np.array:
+        mmu_path = self.build_mmu_classified(build)
+        classified_profile = self.tif_reader_writer.get_profile(self.classified_profile)
+        return self.tif_reader_writer.read_tif(mmu_path, decoder_factor=classified_profile.factor, decoder_nodata=classified_profile.nodata)
 
-    def _get_tif_info(self, something) -> TifInfo:
-        return TifInfo(something)
+    def build_mmu_classified(self, build: bool = False) -> str:
+        classified_path = self.build_classified(build)
+        mmu_path = self.filepath_provider.get_classified_mmu_file()
+        classified_profile = self.tif_reader_writer.get_profile(self.classified_profile)
+        mmu_params = dict(self.comparison_utils.get_params(), profile=classified_profile.get_params())
+        mmu_key = self._get_build_cache().get_key([classified_path], mmu_params, self.comparison_utils.version)
 
-    def _get_indicator_for_all(self, indicator_type: str, indicator_path_func, indicator_func, build: bool = False) -> Indicators:
-        all_reference_timeseries = self.get_all_reference_timeseries()
-        all_mm_paths = self.filepath_provider.get_input_mm_files_by_polarisation()
-        mm_tif_info = self._get_tif_info(all_mm_paths['VV'][0])
+        if build or not self._get_build_cache().is_valid([mmu_path], mmu_key):
+            print('Applying minimum mapping unit')
+            self.comparison_utils.write_mmu(classified_path, mmu_path, self._get_tif_info(classified_path), classified_profile)
+            self._get_build_cache().update([mmu_path], mmu_key)
+        return mmu_path
 
-        indicators = Indicators()
-        for reference_timeseries in all_reference_timeseries:
-            forest_type, polarization = reference_timeseries.polarization, reference_timeseries.forest_type
-            indicator_path = indicator_path_func(polarization, forest_type)
-            print(f'\nCurrent indicator path {indicator_path}')
+    def start_profiling(self):
+        self.profiler.enabled = self.profile_stages
+        self.profiler.cprofile_path = self.filepath_provider.get_cprofile_file() if self.profile_cprofile else None
+        self.profiler.start()
+
+    def write_profile_report(self):
+        self.profiler.stop()
+        if not self.profiler.enabled:
+            return
+        self.profiler.print_report()
+        self.profiler.write_json(self.filepath_provider.get_profile_report_file('json'))
+        self.profiler.write_csv(self.filepath_provider.get_profile_report_file('csv'))
 
-            if not os.path.isfile(indicator_path) or build:
-                print('Calculating tif')
-                indicator = indicator_func(reference_timeseries, all_mm_paths[polarization])
-                self.tif_reader_writer.write_tif(indicator, indicator_path, mm_tif_info, encoder_factor=1, encoder_nodata=-9999)
+    def _get_tif_info(self, something) -> TifInfo:
+        return self.filepath_provider.get_tif_info(something)
 
-            else:
-                print('Loading tif')
-                indicator = self.tif_reader_writer.read_tif(indicator_path, decoder_factor=1, decoder_nodata=-9999)
+    def _get_build_cache(self) -> BuildCache:
+        if self.build_cache is None:
+            self.build_cache = BuildCache(self.filepath_provider.get_build_manifest_file())
+        return self.build_cache
 
-            indicators.push(forest_type, polarization, indicator_type, indicator)
-        return indicators
+    def _get_indicator_key(self, all_reference_timeseries: List[Timeseries], all_mm_paths: dict) -> str:
+        input_paths = [path for mm_paths in all_mm_paths.values() for path in mm_paths]
+        input_paths += [self.filepath_provider.get_timeseries_file(ts.polarization, ts.forest_type) for ts in all_reference_timeseries]
+        return self._get_build_cache().get_key(input_paths, self.tif_reader_writer.get_profile(self.indicator_profile).get_params(),
+                                               self.indicator_calculation.version)
+
+    def _get_classified_key(self, indicator_paths: Dict[Tuple[str, str, str], str]) -> str:
+        classified_profile = self.tif_reader_writer.get_profile(self.classified_profile)
+        return self._get_build_cache().get_key(list(indicator_paths.values()),
+                                               dict(self.forest_classification.get_params(), profile=classified_profile.get_params()),
+                                               self.forest_classification.version)
 
     def confusion_matrix(self):
         classified_path = self.filepath_provider.get_classified_file()
         copernicus_hlr_path = self.filepath_provider.get_copernicus_hlr_file()
-        classified_array = self.tif_reader_writer.read_tif(classified_path, decoder_factor=1, decoder_nodata=-9999)
-        copernicus_array = self.tif_reader_writer.read_tif(copernicus_hlr_path, decoder_factor=1)
+        matrix = self.cmatrix.get_tiled_confusion_matrix(classified_path, copernicus_hlr_path)
+        measures = self.cmatrix.get_measures(matrix)
 
-        print(f'Accuracy: {self.cmatrix.get_overall_accuracy(classified_array, copernicus_array)}')
-        print(f'Kappa: {self.cmatrix.get_kappa(classified_array, copernicus_array)}')
-        print(f'Confusion Matrix: {self.cmatrix.calculate_confusion_matrix(classified_array, copernicus_array)}')
+        print(f'Accuracy: {measures["overall_accuracy"]}')
+        print(f'Kappa: {measures["kappa"]}')
+        print(f'Producer\'s accuracy: {measures["producers_accuracy"]}')
+        print(f'User\'s accuracy: {measures["users_accuracy"]}')
+        print(f'F1: {measures["f1"]}')
+        print(f'Confusion Matrix: {matrix}')
+        return matrix
 
 
 if __name__ == '__main__':
     m = Main()
-    m.get_classified(build=True)
+    m.start_profiling()
+    m.get_mmu_classified(build=True)
+    m.write_profile_report()
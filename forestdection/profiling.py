@@ -0,0 +1,166 @@
+import cProfile
+import csv
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import List, Dict, Optional
+
+
+class _DisabledStage:
+    # Shared by all stages while profiling is disabled, costs one call and an empty with block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add_bytes(self, nbytes: int):
+        pass
+
+
+class _Stage:
+
+    def __init__(self, profiler, name: str, bytes_read: int = 0):
+        self.profiler = profiler
+        self.name = name
+        self.bytes_read = bytes_read
+        self.start = None
+        self.start_rss = None
+
+    def __enter__(self):
+        self.start_rss = get_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        end_rss = get_rss()
+        rss_delta = end_rss - self.start_rss if end_rss is not None and self.start_rss is not None else 0
+        self.profiler.record(self.name, seconds, self.bytes_read, rss_delta)
+        return False
+
+    def add_bytes(self, nbytes: int):
+        self.bytes_read += nbytes
+
+
+class StageProfiler:
+    # Wall time, calls and read bytes per pipeline stage
+    # rss_delta ... largest growth of the current RSS over one call (memory the stage kept, also of concurrent threads),
+    # process_peak_rss ... high-water mark of the process when a call ended, so it is not specific to the stage
+    # Stages may be nested (e.g. decode inside read_cube), so their times are not additive
+    # Stages of the IndicatorCalculation worker processes are merged in (see merge), their seconds add up over the workers
+    # An IndicatorJob worker is a run of its own with its own report
+    enabled = False
+    cprofile_path = None  # additionally dump cProfile stats of the whole run there
+
+    def __init__(self, enabled: bool = None, cprofile_path: str = None):
+        if enabled is not None:
+            self.enabled = enabled
+        if cprofile_path:
+            self.cprofile_path = cprofile_path
+        self.lock = Lock()
+        self.stats = OrderedDict()
+        self._disabled_stage = _DisabledStage()
+        self._cprofile = None
+        self._start = None
+
+    def stage(self, name: str, bytes_read: int = 0):
+        if not self.enabled:
+            return self._disabled_stage
+        return _Stage(self, name, bytes_read)
+
+    def record(self, name: str, seconds: float, bytes_read: int = 0, rss_delta: int = 0):
+        if not self.enabled:
+            return  # also measurements outside of a stage, e.g. the prefetch stalls
+        self.merge({name: {'calls': 1, 'seconds': seconds, 'bytes_read': bytes_read, 'rss_delta': rss_delta,
+                           'process_peak_rss': get_peak_rss()}})
+
+    def merge(self, stats: Dict[str, dict]):
+        # stats of get_stats, e.g. of a worker process
+        with self.lock:
+            for name, other in stats.items():
+                stat = self.stats.get(name)
+                if stat is None:
+                    stat = self.stats[name] = {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'rss_delta': 0, 'process_peak_rss': 0}
+                stat['calls'] += other['calls']
+                stat['seconds'] += other['seconds']
+                stat['bytes_read'] += other['bytes_read']
+                stat['rss_delta'] = max(stat['rss_delta'], other['rss_delta'])
+                stat['process_peak_rss'] = max(stat['process_peak_rss'], other['process_peak_rss'])
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self.lock:
+            return OrderedDict((name, dict(stat)) for name, stat in self.stats.items())
+
+    def start(self):
+        # cProfile is independent of the stage timers
+        if self.enabled:
+            self.reset()
+            self._start = time.perf_counter()
+        if self.cprofile_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            print(f'cProfile stats written to {self.cprofile_path}')
+            self._cprofile = None
+        if self._start is not None:
+            self.record('total', time.perf_counter() - self._start)
+            self._start = None
+
+    def reset(self):
+        with self.lock:
+            self.stats = OrderedDict()
+
+    def get_report(self) -> List[dict]:
+        report = []
+        for name, stat in self.get_stats().items():
+            seconds = stat['seconds']
+            report.append({'stage': name, 'calls': stat['calls'], 'seconds': round(seconds, 6),
+                           'mean_seconds': round(seconds / stat['calls'], 6), 'bytes_read': stat['bytes_read'],
+                           'read_mb_per_s': round(stat['bytes_read'] / seconds / 1e6, 3) if seconds > 0 else None,
+                           'rss_delta_mb': round(stat['rss_delta'] / 1e6, 1),
+                           'process_peak_rss_mb': round(stat['process_peak_rss'] / 1e6, 1)})
+        return report
+
+    def write_json(self, output_path: str):
+        with open(output_path, 'w') as file:
+            json.dump(self.get_report(), file, indent=2)
+
+    def write_csv(self, output_path: str):
+        report = self.get_report()
+        with open(output_path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['stage', 'calls', 'seconds', 'mean_seconds', 'bytes_read', 'read_mb_per_s',
+                                                      'rss_delta_mb', 'process_peak_rss_mb'])
+            writer.writeheader()
+            writer.writerows(report)
+
+    def print_report(self):
+        for row in self.get_report():
+            print(f'{row["stage"]:<20} {row["calls"]:>8} calls {row["seconds"]:>10.3f} s {row["bytes_read"] / 1e6:>10.1f} MB read '
+                  f'{row["rss_delta_mb"]:>10.1f} MB RSS growth {row["process_peak_rss_mb"]:>10.1f} MB process peak RSS')
+
+
+def get_rss() -> Optional[int]:
+    # Current resident set size of the process in bytes, None without /proc (e.g. macOS)
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss() -> int:
+    # Peak resident set size of the process so far in bytes, ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+profiler = StageProfiler()
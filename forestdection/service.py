@@ -1,13 +1,20 @@
-import subprocess
-from typing import List, Tuple
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Tuple, Dict, Optional, Union
 
 import numpy as np
-from scipy.ndimage import generic_filter
-from sklearn.metrics import confusion_matrix, cohen_kappa_score, accuracy_score
+from scipy.ndimage import correlate, label, generate_binary_structure
 
-from forestdection.domain import Timeseries, Indicators
+from forestdection.build_cache import WindowJournal
+from forestdection.domain import Timeseries, Indicators, RasterCube, TifInfo
 from forestdection.filepath import FilepathProvider, get_filename_from_path, get_date_from_filename
-from forestdection.io2 import RasterSegmenter, TifReaderWriter
+from forestdection.io2 import RasterSegmenter, TifReaderWriter, TifWindowWriter, WarpedTifReader, TifProfile, CubePrefetcher, TimeseriesCube
+from forestdection.profiling import profiler
+
+MonthlyMeans = Union[List[str], TimeseriesCube]  # paths of the monthly mean tifs of a polarization or their TimeseriesCube
 
 
 class LinearDbUtils:
@@ -20,87 +27,333 @@ class LinearDbUtils:
 
 
 class ReferenceUtils:
+    version = 1  # of the reference timeseries, see BuildCache.get_key
     filepath_provider = FilepathProvider()
     tif_reader = TifReaderWriter()
-
-    def crop_raster(self, shape_path: str, input_paths: List[str], output_sufix: str) -> List[str]:
-        output_paths = []
-        for inraster in input_paths:
-            input_filename = get_filename_from_path(inraster)
-            outraster = self.filepath_provider.get_cropped_mm_file(input_filename, output_sufix)
-            output_paths.append(outraster)
-            subprocess.call(['gdalwarp', inraster, outraster, '-cutline', shape_path, '-crop_to_cutline'])
-        return output_paths
-
-    def average(self, raster_paths: List[str]) -> Timeseries:
+    profiler = profiler
+
+    def get_reference_mask(self, shape_path: str, raster_path: str) -> Tuple[np.array, Tuple[int, int, int, int]]:
+        # Shape polygons rasterized once on the monthly mean grid, cropped to their bounding box window
+        with self.profiler.stage('reference_mask'):
+            mask, (col_off, row_off, _, _) = self.tif_reader.rasterize_shape(shape_path, TifInfo(raster_path))
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if not rows.size:
+            raise ValueError(f'{shape_path} does not cover any pixel of {raster_path}')
+
+        row_min, row_max, col_min, col_max = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+        window = (col_off + col_min, row_off + row_min, col_max - col_min, row_max - row_min)
+        return mask[row_min:row_max, col_min:col_max], window
+
+    def average(self, raster_paths: List[str], mask: np.array, window: Tuple[int, int, int, int]) -> Timeseries:
         timeseries = Timeseries()
-        raster_paths.sort()
-        for raster_path in raster_paths:
-            data = self.tif_reader.read_tif(raster_path)
-            avg = np.nanmean(data)
+        for raster_path in sorted(raster_paths):
+            data = self.tif_reader.read_tif_window(raster_path, window)
+            avg = np.nanmean(data[mask])
 
             date_str = get_date_from_filename(get_filename_from_path(raster_path))
             timeseries.push(date_str, avg)
         return timeseries
 
-    def get_reference_timeseries(self, forest_type: str, shape_path: str, input_paths: List[str]) -> Timeseries:
-        cropped_mm_paths = self.crop_raster(shape_path, input_paths, forest_type)
-        timeseries = self.average(cropped_mm_paths)
+    def get_reference_timeseries(self, forest_type: str, shape_path: str, input_paths: List[str],
+                                 reference_mask: Tuple[np.array, Tuple[int, int, int, int]] = None) -> Timeseries:
+        # reference_mask ... (mask, window) of get_reference_mask, e.g. shared by the polarizations, rasterized if not given
+        mask, window = reference_mask if reference_mask else self.get_reference_mask(shape_path, input_paths[0])
+        with self.profiler.stage('reference_average'):
+            timeseries = self.average(input_paths, mask, window)
         return timeseries
 
 
 class IndicatorCalculation:
+    version = 2  # of the indicator tifs, 2 ... nodata is stored unscaled (see DeEnCoder.default_encoder)
+    workers = 1
+    prefetch_depth = 1  # cubes read ahead in the background by the serial path, 0 ... no read ahead
+    rmsd_chunk_pixels = 256 * 256  # pixels per matrix product in get_rmsd_all_by_cube
+    profiler = profiler
+
+    def __init__(self, workers: int = None, col_size: int = None, row_size: int = None, memory_budget: int = None,
+                 prefetch_depth: int = None, read_threads: int = None):
+        if workers:
+            self.workers = workers
+        if prefetch_depth is not None:
+            self.prefetch_depth = prefetch_depth
+        self.col_size = col_size
+        self.row_size = row_size
+        self.memory_budget = memory_budget
+        self.read_threads = read_threads  # files of a cube read concurrently, see RasterSegmenter
+
+    def get_all_indicators(self, all_reference_timeseries: List[Timeseries], all_mm_paths: Dict[str, MonthlyMeans]) -> Indicators:
+        # every monthly mean cube is read only once per polarization for all forest types and indicator types
+        indicators = Indicators()
+        for polarization, mm_paths in all_mm_paths.items():
+            reference_timeseries = [ts for ts in all_reference_timeseries if ts.polarization == polarization]
+            if not reference_timeseries:
+                continue
+
+            all_rmsd, all_pearson = self.get_rmsd_and_pearson(reference_timeseries, mm_paths)
+            for timeseries, rmsd, pearson in zip(reference_timeseries, all_rmsd, all_pearson):
+                indicators.push(timeseries.forest_type, polarization, 'rmsd', rmsd)
+                indicators.push(timeseries.forest_type, polarization, 'pearson', pearson)
+        return indicators
+
+    def write_all_indicators(self, all_reference_timeseries: List[Timeseries], all_mm_paths: Dict[str, MonthlyMeans],
+                             indicator_paths: Dict[Tuple[str, str, str], str], tif_info: TifInfo,
+                             encoder_factor: float = None, encoder_nodata=None, profile: TifProfile = None,
+                             journals: Dict[str, WindowJournal] = None):
+        # Same as get_all_indicators, but every finished cube is streamed into its (forest type, polarization, type) tif
+        # journals by polarization record the finished windows, an interrupted run continues with the remaining ones
+        for polarization, mm_paths in all_mm_paths.items():
+            reference_timeseries = [ts for ts in all_reference_timeseries if ts.polarization == polarization]
+            if not reference_timeseries:
+                continue
+
+            rmsd_paths = [indicator_paths[(ts.forest_type, polarization, 'rmsd')] for ts in reference_timeseries]
+            pearson_paths = [indicator_paths[(ts.forest_type, polarization, 'pearson')] for ts in reference_timeseries]
+            journal = journals.get(polarization) if journals else None
+            resume = journal is not None and journal.has_progress() and all(os.path.isfile(path) for path in rmsd_paths + pearson_paths)
+            if journal is not None and not resume:
+                journal.reset()
+
+            rmsd_writers = [TifWindowWriter(path, tif_info, encoder_factor, encoder_nodata, profile, resume) for path in rmsd_paths]
+            pearson_writers = [TifWindowWriter(path, tif_info, encoder_factor, encoder_nodata, profile, resume) for path in pearson_paths]
+            on_window = partial(self._add_to_journal, rmsd_writers + pearson_writers, journal) if journal is not None else None
+            self.write_rmsd_and_pearson(reference_timeseries, mm_paths,
+                                        [w.write_cube for w in rmsd_writers], [w.write_cube for w in pearson_writers],
+                                        journal.is_done if resume else None, on_window, rmsd_writers[0].get_block_size())
+            for writer in rmsd_writers + pearson_writers:
+                writer.close()
+
+    def _add_to_journal(self, writers: List[TifWindowWriter], journal: WindowJournal, window: Tuple[int, int, int, int]):
+        # only windows which are on disk in all outputs are finished
+        for writer in writers:
+            writer.flush()
+        journal.add(window)
+
+    def get_rmsd_and_pearson(self, all_reference_timeseries: List[Timeseries],
+                             actual_paths: MonthlyMeans) -> Tuple[List[np.array], List[np.array]]:
+        raster_segmenter = self.get_raster_segmenter()
+        windows = self.get_windows(raster_segmenter, actual_paths)
+        all_rmsd = [raster_segmenter.get_empty_raster(windows) for _ in all_reference_timeseries]
+        all_pearson = [raster_segmenter.get_empty_raster(windows) for _ in all_reference_timeseries]
+
+        self.write_rmsd_and_pearson(all_reference_timeseries, actual_paths,
+                                    [partial(raster_segmenter.insert_cube, rmsd) for rmsd in all_rmsd],
+                                    [partial(raster_segmenter.insert_cube, pearson) for pearson in all_pearson])
+        return all_rmsd, all_pearson
+
+    def write_rmsd_and_pearson(self, all_reference_timeseries: List[Timeseries], actual_paths: MonthlyMeans, rmsd_sinks: list,
+                               pearson_sinks: list, is_done=None, on_window=None, output_block_size: int = None):
+        # sinks are called with every finished RasterCube, one per reference timeseries
+        # is_done ... windows it returns true for are skipped, on_window ... called with every window after its cubes are in the sinks
+        # output_block_size ... block size of tiled output tifs, see RasterSegmenter
+        raster_segmenter = self.get_raster_segmenter(output_block_size)
+        windows = self.get_windows(raster_segmenter, actual_paths)
+        if is_done:
+            all_windows = len(windows)
+            windows = [window for window in windows if not is_done(window)]
+            print(f'Resuming after {all_windows - len(windows)}/{all_windows} windows')
+        references = [self.get_reference(ts) for ts in all_reference_timeseries]
+
+        print(f'Timeseries: {", ".join(ts.get_description() for ts in all_reference_timeseries)}')
+        indicator_cubes = self._get_indicator_cubes(raster_segmenter, windows, actual_paths, references)
+        for counter, (window, (rmsd_cubes, pearson_cubes)) in enumerate(zip(windows, indicator_cubes), 1):
+            print(f'Indicator Segment Counter: {counter}/{len(windows)}')
+            for rmsd_sink, rmsd_cube in zip(rmsd_sinks, rmsd_cubes):
+                rmsd_sink(rmsd_cube)
+            for pearson_sink, pearson_cube in zip(pearson_sinks, pearson_cubes):
+                pearson_sink(pearson_cube)
+            if on_window:
+                on_window(window)
+
+    def _get_indicator_cubes(self, raster_segmenter: RasterSegmenter, windows: List[Tuple[int, int, int, int]], actual_paths: MonthlyMeans,
+                             references: List[tuple]):
+        # Tiles are independent, so the serial and the parallel path yield the same cubes in the same order
+        if self.workers <= 1:
+            for cube in self.get_cubes(raster_segmenter, actual_paths, windows):
+                yield self.get_indicator_cubes(cube, references)
+            return
+
+        # at most two windows per worker are submitted and not yet consumed, so the results in memory are bound too
+        window_func = partial(get_indicator_cubes_by_window, self, raster_segmenter, actual_paths, references,
+                              profile=self.profiler.enabled)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = deque()
+            for window in windows:
+                futures.append(executor.submit(window_func, window))
+                if len(futures) >= self.workers * 2:
+                    yield self._merge_worker_stats(futures.popleft().result())
+            while futures:
+                yield self._merge_worker_stats(futures.popleft().result())
+
+    def _merge_worker_stats(self, result: tuple) -> Tuple[List[RasterCube], List[RasterCube]]:
+        indicator_cubes, stats = result
+        self.profiler.merge(stats)
+        return indicator_cubes
+
+    def get_raster_segmenter(self, output_block_size: int = None) -> RasterSegmenter:
+        # The memory budget is shared by all cubes in memory: one per worker, or with read ahead see CubePrefetcher
+        memory_budget = self.memory_budget
+        if memory_budget and self.workers > 1:
+            memory_budget = memory_budget // self.workers
+        elif memory_budget and self.prefetch_depth > 0:
+            memory_budget = memory_budget // (self.prefetch_depth + 2)
+        return RasterSegmenter(self.col_size, self.row_size, memory_budget, self.read_threads, output_block_size)
+
+    def get_windows(self, raster_segmenter: RasterSegmenter, actual_paths: MonthlyMeans) -> List[Tuple[int, int, int, int]]:
+        # The tifs are read by raster_segmenter, a TimeseriesCube has its own windows sized by it
+        if isinstance(actual_paths, TimeseriesCube):
+            return actual_paths.get_windows(raster_segmenter)
+        return raster_segmenter.get_windows(actual_paths)
+
+    def get_cube(self, raster_segmenter: RasterSegmenter, actual_paths: MonthlyMeans, window: Tuple[int, int, int, int]) -> RasterCube:
+        if isinstance(actual_paths, TimeseriesCube):
+            return actual_paths.get_cube(window)
+        return raster_segmenter.get_cube(actual_paths, window)
+
+    def get_cubes(self, raster_segmenter: RasterSegmenter, actual_paths: MonthlyMeans, windows: List[Tuple[int, int, int, int]] = None):
+        # Cubes of all windows in order, the next ones are read in the background while the current one is processed
+        windows = windows if windows is not None else self.get_windows(raster_segmenter, actual_paths)
+        if self.prefetch_depth <= 0:
+            for window in windows:
+                yield self.get_cube(raster_segmenter, actual_paths, window)
+            return
+
+        prefetcher = CubePrefetcher(partial(self.get_cube, raster_segmenter, actual_paths), windows, self.prefetch_depth)
+        for cube in prefetcher:
+            yield cube
+        if self.profiler.enabled:
+            self.profiler.record('prefetch_stall', prefetcher.stall_seconds)
+            print(f'Prefetch: {prefetcher.get_stats()}')
+
+    def get_indicator_cubes(self, cube: RasterCube, references: List[tuple]) -> Tuple[List[RasterCube], List[RasterCube]]:
+        rmsd_cubes = []
+        pearson_cubes = []
+        with self.profiler.stage('moments'):
+            cube_moments = self.get_moments_cube(cube.data)  # independent of the reference, calculated once per cube
+        with self.profiler.stage('rmsd'):
+            reference_matrix = np.vstack([timeseries_array for timeseries_array, _, _ in references])
+            all_rmsd, _ = self.get_rmsd_all_by_cube(cube.data, reference_matrix)
+        for idx, (_, reference_std, reference_centered) in enumerate(references):
+            with self.profiler.stage('pearson'):
+                pearson = self.get_pearson_by_cube(cube.data, reference_std, reference_centered, cube_moments)
+            rmsd_cubes.append(RasterCube(cube.col_off, cube.row_off, all_rmsd[:, :, idx]))
+            pearson_cubes.append(RasterCube(cube.col_off, cube.row_off, pearson))
+        return rmsd_cubes, pearson_cubes
+
+    def get_reference(self, reference_timeseries: Timeseries) -> Tuple[np.array, float, np.array]:
+        reference_std, reference_centered = self.get_centered_std_timeseries(reference_timeseries.sig0s)
+        return np.array(reference_timeseries.sig0s), reference_std, reference_centered
 
-    def get_rmsd(self, reference_timeseries: Timeseries, actual_paths: List[str]) -> np.array:
+    def get_rmsd(self, reference_timeseries: Timeseries, actual_paths: MonthlyMeans) -> np.array:
         rmsd_cubes = []
-        raster_segmenter = RasterSegmenter()
-        ts_size = reference_timeseries.get_size()
+        raster_segmenter = self.get_raster_segmenter()
 
         print(f'Timeseries: {reference_timeseries.get_description()}')
-        counter = 1
-        cube = raster_segmenter.get_next_cube(actual_paths)
-
         timeseries_array = np.array(reference_timeseries.sig0s)
-        while cube:
+        for counter, cube in enumerate(self.get_cubes(raster_segmenter, actual_paths), 1):
             print(f'RMSD Segment Counter: {counter}')
-            cube.data = np.square(cube.data - timeseries_array[None, None, :])  # per pixel
-            cube.data = np.nansum(cube.data, axis=2)  # sums all nan values to 0
-            cube.data[cube.data == 0] = np.nan  # set nan sums to nan again
-            cube.data = np.sqrt(cube.data / ts_size)  # combining pixel
-
+            cube.data = self.get_rmsd_by_cube(cube.data, timeseries_array)
             rmsd_cubes.append(cube)
-            counter += 1
-            cube = raster_segmenter.get_next_cube(actual_paths)
 
         raster = raster_segmenter.get_rmsd_from_cubes(rmsd_cubes)
         del rmsd_cubes
         return raster
 
-    def get_pearson(self, reference_timeseries: Timeseries, actual_paths: List[str]) -> np.array:
+    def get_rmsd_by_cube(self, cube_data: np.array, timeseries_array: np.array) -> np.array:
+        rmsd, _ = self.get_rmsd_all_by_cube(cube_data, timeseries_array[None, :])
+        return rmsd[:, :, 0]
+
+    def get_rmsd_all_by_cube(self, cube_data: np.array, reference_matrix: np.array) -> Tuple[np.array, np.array]:
+        # RMSD of every pixel against all K references (K, T) in one pass, sum (x - r)^2 = sum x^2 - 2 sum x r + sum r^2
+        # over the months where pixel and reference are valid, normalised by that count
+        # count 0 (all nan) -> nan, an exact match stays 0
+        rows, cols, size = cube_data.shape
+        reference_valid = ~np.isnan(reference_matrix)
+        references = np.where(reference_valid, reference_matrix, 0).astype(np.float64)
+        reference_valid = reference_valid.astype(np.float64)
+        reference_squares = references * references
+
+        rmsd = np.empty((rows, cols, reference_matrix.shape[0]), dtype=cube_data.dtype)
+        counts = np.empty((rows, cols, reference_matrix.shape[0]), dtype=np.int32)
+        chunk_rows = max(1, self.rmsd_chunk_pixels // max(cols, 1))
+        for row_min in range(0, rows, chunk_rows):
+            row_max = min(row_min + chunk_rows, rows)
+            chunk = cube_data[row_min:row_max].reshape(-1, size).astype(np.float64)
+            valid = ~np.isnan(chunk)
+            np.copyto(chunk, 0, where=~valid)
+            valid = valid.astype(np.float64)
+
+            count = valid @ reference_valid.T
+            ssd = np.square(chunk) @ reference_valid.T
+            ssd -= 2 * (chunk @ references.T)
+            ssd += valid @ reference_squares.T
+            np.maximum(ssd, 0, out=ssd)  # rounding of the expansion
+            with np.errstate(invalid='ignore', divide='ignore'):
+                chunk_rmsd = np.sqrt(ssd / count)
+
+            rmsd[row_min:row_max] = chunk_rmsd.reshape(row_max - row_min, cols, -1)
+            counts[row_min:row_max] = count.reshape(row_max - row_min, cols, -1)
+        return rmsd, counts
+
+    def get_pearson(self, reference_timeseries: Timeseries, actual_paths: MonthlyMeans) -> np.array:
         pearson_cubes = []
-        raster_segmenter = RasterSegmenter()
+        raster_segmenter = self.get_raster_segmenter()
 
         reference_std, reference_centered = self.get_centered_std_timeseries(reference_timeseries.sig0s)
         print(f'Timeseries: {reference_timeseries.get_description()}')
-        counter = 1
-        cube = raster_segmenter.get_next_cube(actual_paths)
-        while cube:
+        for counter, cube in enumerate(self.get_cubes(raster_segmenter, actual_paths), 1):
             print(f'Pearson Segment Counter: {counter}')
             cube.data = self.get_pearson_by_cube(cube.data, reference_std, reference_centered)
             pearson_cubes.append(cube)
-            counter += 1
-            cube = raster_segmenter.get_next_cube(actual_paths)
 
         raster = raster_segmenter.get_pearson_from_cubes(pearson_cubes)
         del pearson_cubes
         return raster
 
-    def get_pearson_by_cube(self, cube_data: np.array, reference_std: float, reference_centered: np.array):
-        cube_std, cube_centered = self.get_centered_std_cube(cube_data)
-        numerator = np.nansum(cube_centered * reference_centered, axis=2) / (cube_data.shape[2] - 1)
+    def get_pearson_by_cube(self, cube_data: np.array, reference_std: float, reference_centered: np.array,
+                            cube_moments: Tuple[np.array, np.array] = None):
+        # Accumulates band by band, so only a few 2D arrays are allocated instead of several centered cubes
+        cube_mean, cube_std = cube_moments if cube_moments else self.get_moments_cube(cube_data)
+        size = cube_data.shape[2]
+        cross = np.zeros(cube_mean.shape)
+        centered = np.empty(cube_mean.shape)
+        for t in range(size):
+            if np.isnan(reference_centered[t]):
+                continue  # nansum skips the whole band
+            np.subtract(cube_data[:, :, t], cube_mean, out=centered)
+            np.copyto(centered, 0, where=np.isnan(centered))
+            centered *= reference_centered[t]
+            cross += centered
+
+        numerator = cross / (size - 1)
         denominator = cube_std * reference_std
-        cube_data = numerator / denominator
-        return cube_data
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pearson = numerator / denominator
+        return pearson.astype(cube_data.dtype)
+
+    def get_moments_cube(self, cube_data: np.array) -> Tuple[np.array, np.array]:
+        # Same as get_centered_std_cube (nan mean, std normalised by the full size), without the centered cube
+        size = cube_data.shape[2]
+        total = np.zeros(cube_data.shape[:2])
+        count = np.zeros(cube_data.shape[:2])
+        band = np.empty(cube_data.shape[:2])
+        for t in range(size):
+            band[:] = cube_data[:, :, t]
+            valid = ~np.isnan(band)
+            count += valid
+            np.copyto(band, 0, where=~valid)
+            total += band
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count  # all nan pixels stay nan
+
+        squares = np.zeros(cube_data.shape[:2])
+        for t in range(size):
+            np.subtract(cube_data[:, :, t], mean, out=band)
+            np.copyto(band, 0, where=np.isnan(band))
+            band *= band
+            squares += band
+        std = np.sqrt(squares / (size - 1))
+        return mean, std
 
     def get_centered_std_cube(self, cube_data: np.array):
         size = cube_data.shape[2]
@@ -115,15 +368,223 @@ class IndicatorCalculation:
         return std, centered
 
 
-class ForestClassification:
+def get_indicator_cubes_by_window(indicator_calculation: IndicatorCalculation, raster_segmenter: RasterSegmenter, actual_paths: MonthlyMeans,
+                                  references: List[tuple], window: Tuple[int, int, int, int], profile: bool = False) -> tuple:
+    # Module level so it can be pickled into the worker processes
+    # Returns the indicator cubes and the stages of this window, profiled in the worker if the calling process profiles
+    profiler.enabled = profile
+    profiler.reset()
+    cube = indicator_calculation.get_cube(raster_segmenter, actual_paths, window)
+    return indicator_calculation.get_indicator_cubes(cube, references), profiler.get_stats()
+
+
+class IndicatorStatistics:
+    # Per pixel sufficient statistics of one polarization, a new monthly mean is folded in without reading the full stack
+    # shared: number of valid months, sum and sum of squares of sig0
+    # per forest type (only months with a reference value): sums of sig0 times, of and of squares of the scalar reference values
+    # Months without a reference value of a forest type are read again by write_indicators and subtracted from the shared sums
+    # Every window is folded in place, its new values are saved before they are written, so a crash counts no month twice
+    version = 2
+    sig0_offset = -10.  # dB, sig0 and references are folded relative to it, the float32 sums of a typical sig0 stay small
+    shared_names = ['count', 'sum', 'sum_squares']
+    reference_names = ['cross_products', 'reference_sums', 'reference_squares']
+    indicator_calculation = IndicatorCalculation()
+
+    def __init__(self, folder: str, col_size: int = None, row_size: int = None):
+        self.folder = folder
+        self.meta_path = os.path.join(folder, 'statistics.json')
+        self.journal_path = os.path.join(folder, 'statistics.journal')
+        self.redo_path = os.path.join(folder, 'statistics.redo.npz')
+        self.raster_segmenter = RasterSegmenter(col_size, row_size)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.meta_path)
+
+    def get_meta(self) -> dict:
+        with open(self.meta_path, 'r') as file:
+            return json.load(file)
+
+    def get_dates(self) -> List[str]:
+        return self.get_meta()['dates'] if self.exists() else []
+
+    def is_valid(self, all_reference_timeseries: List[Timeseries], mm_paths: List[str], size_x: int, size_y: int) -> bool:
+        # The folded months are only valid for the forest types, monthly means and reference values they were folded with
+        if not self.exists():
+            return False
+        meta = self.get_meta()
+        if meta.get('version') != self.version or sorted(meta['forest_types']) != sorted(ts.forest_type for ts in all_reference_timeseries) \
+                or (meta['size_x'], meta['size_y']) != (size_x, size_y):
+            return False
+        return all(meta['paths'][date] in mm_paths and meta['reference_values'][date] ==
+                   self._get_meta_reference_values(self.get_reference_values(all_reference_timeseries, date)) for date in meta['dates'])
+
+    def get_reference_values(self, all_reference_timeseries: List[Timeseries], date: str) -> Dict[str, float]:
+        # value of every forest type's reference timeseries at date, nan if it has none
+        return {ts.forest_type: dict(zip(ts.dates, ts.sig0s)).get(date, np.nan) for ts in all_reference_timeseries}
+
+    def create(self, forest_types: List[str], size_x: int, size_y: int):
+        for path in [self.journal_path, self.redo_path]:
+            if os.path.isfile(path):
+                os.remove(path)  # of an interrupted fold into the old statistics
+        for name in self._get_all_names(forest_types):
+            self._create(name, size_x, size_y)[:] = 0
+        self._write_meta({'version': self.version, 'dates': [], 'forest_types': forest_types, 'size_x': size_x, 'size_y': size_y,
+                          'paths': {}, 'reference_values': {}})
+
+    def add_month(self, mm_path: str, reference_values: Dict[str, float]):
+        # reference_values: value of every forest type's reference timeseries at the month of mm_path, see get_reference_values
+        meta = self.get_meta()
+        date = get_date_from_filename(get_filename_from_path(mm_path))
+        if date in meta['dates']:
+            return
+
+        # An interrupted fold of the same month continues after its finished windows
+        journal = WindowJournal(self.journal_path, json.dumps([date, self._get_meta_reference_values(reference_values)]))
+        stats = {name: self._open(name) for name in self._get_all_names(meta['forest_types'])}
+        self._redo(stats, journal)
+        for window in self.raster_segmenter.get_windows([mm_path]):
+            if journal.is_done(window):
+                continue
+            col_off, row_off, col_size, row_size = window
+            rows, cols = slice(row_off, row_off + row_size), slice(col_off, col_off + col_size)
+            band = self.raster_segmenter.get_cube([mm_path], window).data[:, :, 0].astype(np.float64) - self.sig0_offset
+            valid = ~np.isnan(band)
+            band[~valid] = 0
+
+            updates = {'count': valid, 'sum': band, 'sum_squares': band * band}
+            for forest_type in meta['forest_types']:
+                reference_value = reference_values[forest_type] - self.sig0_offset
+                if np.isnan(reference_value):
+                    continue  # nansum skips months without a reference value
+                updates[f'cross_products_{forest_type}'] = band * reference_value
+                updates[f'reference_sums_{forest_type}'] = reference_value * valid
+                updates[f'reference_squares_{forest_type}'] = reference_value * reference_value * valid
+            values = {name: (stats[name][rows, cols] + update).astype(stats[name].dtype) for name, update in updates.items()}
+            self._save_redo(journal.key, window, values)
+            self._write_window(stats, window, values)
+            journal.add(window)
+        del stats
+
+        meta['dates'] = sorted(meta['dates'] + [date])
+        meta['paths'][date] = mm_path
+        meta['reference_values'][date] = self._get_meta_reference_values(reference_values)
+        self._write_meta(meta)
+        journal.reset()
+        if os.path.isfile(self.redo_path):
+            os.remove(self.redo_path)
+
+    def write_indicators(self, all_reference_timeseries: List[Timeseries], rmsd_sinks: list, pearson_sinks: list):
+        # Same results as IndicatorCalculation.write_rmsd_and_pearson for all folded months, in one pass over the statistics
+        meta = self.get_meta()
+        size = len(meta['dates'])
+        stats = {name: self._open(name, 'r') for name in self._get_all_names(meta['forest_types'])}
+        references = [(timeseries.forest_type, np.nanmean(timeseries.sig0s) - self.sig0_offset,
+                       self.indicator_calculation.get_centered_std_timeseries(timeseries.sig0s)[0],
+                       [meta['paths'][date] for date in meta['dates'] if meta['reference_values'][date][timeseries.forest_type] is None])
+                      for timeseries in all_reference_timeseries]
+
+        for window in self.raster_segmenter.get_grid(meta['size_x'], meta['size_y']):
+            col_off, row_off, col_size, row_size = window
+            window_stats = {name: stat[row_off:row_off + row_size, col_off:col_off + col_size].astype(np.float64)
+                            for name, stat in stats.items()}
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = window_stats['sum'] / window_stats['count']
+                std = np.sqrt((window_stats['sum_squares'] - window_stats['sum'] * mean) / (size - 1))
+
+            for (forest_type, reference_mean, reference_std, skipped_paths), rmsd_sink, pearson_sink in \
+                    zip(references, rmsd_sinks, pearson_sinks):
+                # sig0 of the months where the reference is valid
+                count, total, squares = window_stats['count'], window_stats['sum'], window_stats['sum_squares']
+                if skipped_paths:
+                    skipped = self.raster_segmenter.get_cube(skipped_paths, window).data.astype(np.float64) - self.sig0_offset
+                    skipped_valid = ~np.isnan(skipped)
+                    np.copyto(skipped, 0, where=~skipped_valid)
+                    count = count - skipped_valid.sum(axis=2)
+                    total = total - skipped.sum(axis=2)
+                    squares = squares - np.square(skipped).sum(axis=2)
+
+                # sum of (sig0 - reference)^2, same as get_rmsd_all_by_cube, no valid month -> nan
+                cross_products = window_stats[f'cross_products_{forest_type}']
+                reference_sums = window_stats[f'reference_sums_{forest_type}']
+                squared_deviations = np.maximum(squares - 2 * cross_products + window_stats[f'reference_squares_{forest_type}'], 0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    rmsd = np.sqrt(squared_deviations / count)
+
+                # sum of (sig0 - mean) * (reference - reference mean) over the months where both are valid
+                cross = cross_products - mean * reference_sums - reference_mean * (total - mean * count)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    pearson = cross / (size - 1) / (std * reference_std)
+
+                rmsd_sink(RasterCube(col_off, row_off, rmsd.astype(np.float32)))
+                pearson_sink(RasterCube(col_off, row_off, pearson.astype(np.float32)))
+
+    def _redo(self, stats: Dict[str, np.array], journal: WindowJournal):
+        # values of a window which were saved but maybe not completely written, they are absolute, so writing twice does not count twice
+        if not os.path.isfile(self.redo_path):
+            return
+        with np.load(self.redo_path) as redo:
+            window = tuple(int(value) for value in redo['window'])
+            if str(redo['key']) == journal.key and not journal.is_done(window):
+                self._write_window(stats, window, {name: redo[name] for name in redo.files if name not in ['window', 'key']})
+                journal.add(window)
+
+    def _save_redo(self, key: str, window: Tuple[int, int, int, int], values: Dict[str, np.array]):
+        tmp_path = f'{self.redo_path}.tmp.npz'
+        np.savez(tmp_path, window=np.array(window), key=np.array(key), **values)
+        with open(tmp_path, 'rb') as file:
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.redo_path)
+
+    def _write_window(self, stats: Dict[str, np.array], window: Tuple[int, int, int, int], values: Dict[str, np.array]):
+        col_off, row_off, col_size, row_size = window
+        for name, value in values.items():
+            stats[name][row_off:row_off + row_size, col_off:col_off + col_size] = value
+        for name in values:
+            stats[name].flush()
+
+    def _get_all_names(self, forest_types: List[str]) -> List[str]:
+        return self.shared_names + [f'{name}_{forest_type}' for name in self.reference_names for forest_type in forest_types]
+
+    def _get_meta_reference_values(self, reference_values: Dict[str, float]) -> Dict[str, Optional[float]]:
+        # json has no nan
+        return {forest_type: None if np.isnan(value) else float(value) for forest_type, value in reference_values.items()}
+
+    def _get_path(self, name: str) -> str:
+        return os.path.join(self.folder, f'{name}.npy')
+
+    def _open(self, name: str, mode: str = 'r+') -> np.array:
+        return np.lib.format.open_memmap(self._get_path(name), mode=mode)
+
+    def _create(self, name: str, size_x: int, size_y: int) -> np.array:
+        # counts of months fit into uint16, sums of sig0 in dB into float32
+        dtype = np.uint16 if name == 'count' else np.float32
+        return np.lib.format.open_memmap(self._get_path(name), mode='w+', dtype=dtype, shape=(size_y, size_x))
+
+    def _write_meta(self, meta: dict):
+        # renamed, a torn meta is never read
+        tmp_path = f'{self.meta_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, self.meta_path)
+
 
-    def classify_forest(self, rmsd: Indicators, pearson: Indicators):
-        # rmsd / pearson are 3D numpy arrays first two dim geographic extend, third are different forest types
-        rmsd_vh = rmsd.get_data_by_description(polarization='VH')
-        rmsd_vv = rmsd.get_data_by_description(polarization='VV')
-        pearson_vh = pearson.get_data_by_description(polarization='VH')
-        del rmsd
-        del pearson
+class ForestClassification:
+    version = 1  # of the classified tif
+    rmsd_vh_threshold = 1.5
+    rmsd_vv_threshold = 2.0
+    pearson_vh_threshold = 0.4
+    profiler = profiler
+
+    def get_params(self) -> dict:
+        return {'rmsd_vh_threshold': self.rmsd_vh_threshold, 'rmsd_vv_threshold': self.rmsd_vv_threshold,
+                'pearson_vh_threshold': self.pearson_vh_threshold}
+
+    def classify_forest(self, indicators: Indicators):
+        # indicators are 3D numpy arrays first two dim geographic extend, third are different forest types
+        rmsd_vh = indicators.get_data_by_description(polarization='VH', type_='rmsd')
+        rmsd_vv = indicators.get_data_by_description(polarization='VV', type_='rmsd')
+        pearson_vh = indicators.get_data_by_description(polarization='VH', type_='pearson')
+        del indicators
         forest_mask = self.get_forest_mask(rmsd_vh, rmsd_vv, pearson_vh)
 
         # forest classification based on highest RMSD VH value
@@ -136,35 +597,165 @@ class ForestClassification:
         # 2 ... second forest type
         return forest_type_index_raster * forest_mask
 
+    def write_classified(self, indicator_paths: Dict[Tuple[str, str, str], str], output_path: str, tif_info: TifInfo,
+                         indicator_profile: TifProfile = None, profile: TifProfile = None):
+        # Streams aligned windows of all (forest type, polarization, type) indicator tifs, only one tile is in memory
+        # 0 / 1 / 2 classes are written with the (UInt8) classified profile
+        tif_reader_writer = TifReaderWriter()
+        indicator_profile = indicator_profile if indicator_profile else tif_reader_writer.get_profile('indicator')
+        profile = profile if profile else tif_reader_writer.get_profile('classified')
+        writer = TifWindowWriter(output_path, tif_info, profile=profile)
+        for window in RasterSegmenter().get_windows(list(indicator_paths.values())):
+            indicators = Indicators(capacity=len(indicator_paths))
+            for (forest_type, polarization, indicator_type), indicator_path in indicator_paths.items():
+                indicator = tif_reader_writer.read_tif_window(indicator_path, window, decoder_factor=indicator_profile.factor,
+                                                              decoder_nodata=indicator_profile.nodata)
+                indicators.push(forest_type, polarization, indicator_type, indicator)
+
+            with self.profiler.stage('classify_forest'):
+                forest_class = self.classify_forest(indicators).astype(np.uint8)
+            writer.write_cube(RasterCube(window[0], window[1], forest_class))
+        writer.close()
+
     def get_forest_mask(self, rmsd_vh: np.array, rmsd_vv: np.array, pearson_vh: np.array) -> np.array:
         # RMSD VH < 1.5 dB and RMSD VV < 2.0 dB and Pearson VH > 0.4 -> 1 otherwise 0
-        mask_rmsd_vh = np.any((rmsd_vh < 1.5), axis=2)
-        mask_rmsd_vv = np.any(rmsd_vv < 2.0, axis=2)
-        mask_pearson_vh = np.any(pearson_vh > 0.4, axis=2)
+        mask_rmsd_vh = np.any((rmsd_vh < self.rmsd_vh_threshold), axis=2)
+        mask_rmsd_vv = np.any(rmsd_vv < self.rmsd_vv_threshold, axis=2)
+        mask_pearson_vh = np.any(pearson_vh > self.pearson_vh_threshold, axis=2)
         return (mask_rmsd_vh * mask_rmsd_vv * mask_pearson_vh).astype(int)
     
 
 class AccuracyMeasure:
+    # 0 ... no forest, 1 ... first forest type, 2 ... second forest type, other values (nodata, outside area) are ignored
+    classes = [0, 1, 2]
+    tif_reader_writer = TifReaderWriter()
+    profiler = profiler
 
     def get_kappa(self, classified: np.array, hrl: np.array):
-        return cohen_kappa_score(hrl.flatten(), classified.flatten())
+        return self.get_measures(self.get_confusion_matrix(classified, hrl))['kappa']
 
     def get_overall_accuracy(self, classified: np.array, hrl: np.array):
-        return accuracy_score(hrl.flatten(), classified.flatten())
+        return self.get_measures(self.get_confusion_matrix(classified, hrl))['overall_accuracy']
 
     def calculate_confusion_matrix(self, classified: np.array, hrl: np.array) -> np.array:
-        return confusion_matrix(hrl.flatten(), classified.flatten(), normalize=True)
+        matrix = self.get_confusion_matrix(classified, hrl)
+        return matrix / matrix.sum()
+
+    def get_confusion_matrix(self, classified: np.array, hrl: np.array, matrix: np.array = None) -> np.array:
+        # rows ... hrl (reference), columns ... classified, counts are added to matrix if given
+        num_classes = len(self.classes)
+        if matrix is None:
+            matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+        classes = np.array(self.classes)
+        classified, hrl = classified.ravel(), hrl.ravel()
+        classified_idx = np.searchsorted(classes, classified).clip(0, num_classes - 1)
+        hrl_idx = np.searchsorted(classes, hrl).clip(0, num_classes - 1)
+        valid = (classes[classified_idx] == classified) & (classes[hrl_idx] == hrl)  # also false for nan
+
+        counts = np.bincount(hrl_idx[valid] * num_classes + classified_idx[valid], minlength=num_classes * num_classes)
+        matrix += counts.reshape((num_classes, num_classes))
+        return matrix
+
+    def get_tiled_confusion_matrix(self, classified_path: str, hrl_path: str) -> np.array:
+        # The hrl is warped window by window onto the classified grid, memory is bound by one window
+        # outside of the hrl footprint it is nan and not counted
+        hrl_reader = WarpedTifReader(hrl_path, TifInfo(classified_path))
+
+        matrix = None
+        for window in RasterSegmenter().get_windows([classified_path]):
+            classified = self.tif_reader_writer.read_tif_window(classified_path, window, decoder_factor=1, decoder_nodata=-9999)
+            hrl = hrl_reader.read_window(window, decoder_factor=1)
+            with self.profiler.stage('confusion_matrix'):
+                matrix = self.get_confusion_matrix(classified, hrl, matrix)
+        hrl_reader.close()
+        return matrix
+
+    def get_measures(self, matrix: np.array) -> dict:
+        total = matrix.sum()
+        diagonal = np.diag(matrix).astype(float)
+        reference_sums = matrix.sum(axis=1)
+        classified_sums = matrix.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            overall_accuracy = diagonal.sum() / total
+            expected_accuracy = (reference_sums * classified_sums).sum() / float(total) ** 2
+            kappa = (overall_accuracy - expected_accuracy) / (1 - expected_accuracy)
+            producers_accuracy = diagonal / reference_sums
+            users_accuracy = diagonal / classified_sums
+            f1 = 2 * producers_accuracy * users_accuracy / (producers_accuracy + users_accuracy)
+
+        return {'overall_accuracy': overall_accuracy, 'kappa': kappa, 'producers_accuracy': producers_accuracy,
+                'users_accuracy': users_accuracy, 'f1': f1}
 
 
 class ComparisonUtils:
-
-    def _check_mmu(self, values):
-        val_sum = np.nansum(values)
-        return int(val_sum >= 5)
-
-    def apply_mmu(self, data: np.array):
-        footprint = np.ones((3, 3))
-        return generic_filter(data, self._check_mmu, footprint=footprint)
+    # window ... pixels need threshold forest pixels in their window_size neighbourhood, area ... connected areas of min_area
+    version = 1  # of the minimum mapping unit tif
+    mmu_mode = 'window'
+    mmu_window_size = 3
+    mmu_threshold = 5
+    mmu_min_area = 5
+    mmu_connectivity = 2  # 1 ... 4 neighbours, 2 ... 8 neighbours
+    tif_reader_writer = TifReaderWriter()
+    profiler = profiler
+
+    def get_params(self) -> dict:
+        return {'mmu_mode': self.mmu_mode, 'mmu_window_size': self.mmu_window_size, 'mmu_threshold': self.mmu_threshold,
+                'mmu_min_area': self.mmu_min_area, 'mmu_connectivity': self.mmu_connectivity}
+
+    def apply_mmu(self, data: np.array, window_size: int = None, threshold: int = None):
+        # 1 where the nan sum of the neighbourhood reaches the threshold, one correlation instead of a python call per pixel
+        window_size = window_size if window_size else self.mmu_window_size
+        threshold = threshold if threshold else self.mmu_threshold
+        footprint = np.ones((window_size, window_size))
+        sums = correlate(np.nan_to_num(data.astype(float)), footprint, mode='reflect')
+        return (sums >= threshold).astype(data.dtype)
+
+    def apply_mmu_area(self, data: np.array, min_area: int = None, connectivity: int = None):
+        # Connected areas of one class smaller than min_area pixels become 0 (no forest)
+        min_area = min_area if min_area else self.mmu_min_area
+        connectivity = connectivity if connectivity else self.mmu_connectivity
+        structure = generate_binary_structure(2, connectivity)
+
+        filtered = data.copy()
+        for value in np.unique(data[data > 0]):
+            labels, _ = label(data == value, structure)
+            too_small = np.bincount(labels.ravel()) < min_area
+            too_small[0] = False  # background
+            filtered[too_small[labels]] = 0
+        return filtered
+
+    def filter_classified(self, classified: np.array) -> np.array:
+        if self.mmu_mode == 'area':
+            return self.apply_mmu_area(classified)
+
+        forest = (classified > 0).astype(float)
+        forest[np.isnan(classified)] = np.nan
+        filtered = np.where(self.apply_mmu(forest) > 0, classified, 0)
+        filtered[np.isnan(classified)] = np.nan
+        return filtered
+
+    def get_halo(self) -> int:
+        # A component which reaches the core of a tile and has min_area pixels has them within min_area pixels
+        return self.mmu_min_area if self.mmu_mode == 'area' else self.mmu_window_size // 2
+
+    def write_mmu(self, input_path: str, output_path: str, tif_info: TifInfo, profile: TifProfile = None):
+        # Tile by tile with a halo around every window, so the result equals filtering the full raster
+        # profile of the classified input and the filtered output
+        halo = self.get_halo()
+        profile = profile if profile else self.tif_reader_writer.get_profile('classified')
+        writer = TifWindowWriter(output_path, tif_info, profile=profile)
+        for col_off, row_off, col_size, row_size in RasterSegmenter().get_windows([input_path]):
+            col_min, row_min = max(0, col_off - halo), max(0, row_off - halo)
+            col_max, row_max = min(tif_info.size_x, col_off + col_size + halo), min(tif_info.size_y, row_off + row_size + halo)
+            data = self.tif_reader_writer.read_tif_window(input_path, (col_min, row_min, col_max - col_min, row_max - row_min),
+                                                          decoder_factor=profile.factor, decoder_nodata=profile.nodata)
+            with self.profiler.stage('mmu'):
+                filtered = self.filter_classified(data)
+            core = filtered[row_off - row_min:row_off - row_min + row_size, col_off - col_min:col_off - col_min + col_size]
+            writer.write_cube(RasterCube(col_off, row_off, core))
+        writer.close()
 
     def crop_raster_with_raster(self, to_crop_path: str, raster_path: str):
         pass
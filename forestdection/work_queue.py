@@ -0,0 +1,273 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from forestdection.domain import Timeseries, Indicators, RasterCube, TifInfo
+from forestdection.io2 import TifWindowWriter, TifProfile
+from forestdection.main import Main
+
+
+class FileWorkQueue:
+    # Tasks in a folder on a shared filesystem, claimed by any number of worker processes on any number of hosts
+    # tasks.json ... all tasks by id, written once by create
+    # claims/<task id>.<attempt>.lock ... created exclusively (O_CREAT | O_EXCL is atomic, also on NFS), the highest attempt is the claim
+    # done/<task id>.json ... written by rename once the output of the task is complete
+    # A claim without heartbeat for claim_timeout seconds (crashed worker) is taken over with the next attempt,
+    # only one worker can create that lock. SQLite is not used, its locking is not reliable on network filesystems
+    claim_timeout = 3600  # compared with the mtime of the lock, so the clocks of the hosts have to be roughly in sync
+    max_attempts = 3
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.tasks_path = os.path.join(folder, 'tasks.json')
+        self.claims_folder = os.path.join(folder, 'claims')
+        self.done_folder = os.path.join(folder, 'done')
+        self.tasks = None
+        self.attempts = {}  # task id -> attempt claimed by this process
+
+    def create(self, tasks: Dict[str, dict]):
+        # Replaces the tasks, claims and done markers of an earlier job in folder
+        for folder in [self.claims_folder, self.done_folder]:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+        _write_json(self.tasks_path, tasks)
+        self.tasks = tasks
+
+    def get_tasks(self) -> Dict[str, dict]:
+        if self.tasks is None:
+            with open(self.tasks_path, 'r') as file:
+                self.tasks = json.load(file)
+        return self.tasks
+
+    def claim(self) -> Optional[Tuple[str, dict]]:
+        # Next task which is neither done nor claimed by a live worker, None if there is none
+        tasks = self.get_tasks()
+        done = set(os.listdir(self.done_folder))
+        claims = self._get_claims()
+        for task_id in sorted(tasks):
+            if f'{task_id}.json' in done:
+                continue
+            attempt = 0
+            if task_id in claims:
+                attempt, lock_path = claims[task_id]
+                if attempt >= self.max_attempts or not self._is_stale(lock_path):
+                    continue
+            if not self._try_lock(task_id, attempt + 1):
+                continue  # another worker was faster
+            if self.is_done(task_id):
+                continue  # the stale claim finished in the meantime
+            self.attempts[task_id] = attempt + 1
+            return task_id, tasks[task_id]
+        return None
+
+    def heartbeat(self, task_id: str):
+        # Long tasks keep their claim alive
+        os.utime(self._get_lock_path(task_id, self.attempts[task_id]), None)
+
+    def release(self, task_id: str):
+        # Failed task, the claim becomes stale at once so another worker retries it (up to max_attempts)
+        os.utime(self._get_lock_path(task_id, self.attempts.pop(task_id)), (0, 0))
+
+    def complete(self, task_id: str, result: dict = None):
+        done = {'host': socket.gethostname(), 'pid': os.getpid(), 'attempt': self.attempts.pop(task_id, None), 'result': result}
+        _write_json(os.path.join(self.done_folder, f'{task_id}.json'), done)
+
+    def is_done(self, task_id: str) -> bool:
+        return os.path.isfile(os.path.join(self.done_folder, f'{task_id}.json'))
+
+    def is_finished(self) -> bool:
+        done = set(os.listdir(self.done_folder))
+        return all(f'{task_id}.json' in done for task_id in self.get_tasks())
+
+    def get_progress(self) -> dict:
+        done = set(os.listdir(self.done_folder))
+        claims = self._get_claims()
+        open_tasks = [task_id for task_id in self.get_tasks() if f'{task_id}.json' not in done]
+        failed = [task_id for task_id in open_tasks if task_id in claims and claims[task_id][0] >= self.max_attempts
+                  and self._is_stale(claims[task_id][1])]
+        return {'tasks': len(self.get_tasks()), 'done': len(self.get_tasks()) - len(open_tasks),
+                'claimed': len([task_id for task_id in open_tasks if task_id in claims]) - len(failed), 'failed': len(failed)}
+
+    def _get_claims(self) -> Dict[str, Tuple[int, str]]:
+        claims = {}
+        for name in os.listdir(self.claims_folder):
+            if not name.endswith('.lock'):
+                continue
+            task_id, attempt, _ = name.rsplit('.', 2)
+            if int(attempt) > claims.get(task_id, (0, None))[0]:
+                claims[task_id] = (int(attempt), os.path.join(self.claims_folder, name))
+        return claims
+
+    def _get_lock_path(self, task_id: str, attempt: int) -> str:
+        return os.path.join(self.claims_folder, f'{task_id}.{attempt}.lock')
+
+    def _try_lock(self, task_id: str, attempt: int) -> bool:
+        try:
+            fd = os.open(self._get_lock_path(task_id, attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, file)
+        return True
+
+    def _is_stale(self, lock_path: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(lock_path) > self.claim_timeout
+        except FileNotFoundError:
+            return True
+
+
+class IndicatorJob:
+    # Indicators and classification of the tile of main, one task per window of a FileWorkQueue in folder
+    # create ... once, work ... in any number of processes on any number of hosts, finalize ... once all tasks are done
+    # Every task writes the indicator and classified windows as partial output (parts/<task id>.npz),
+    # finalize assembles them into the result tifs and registers them in the build manifest
+    # The indicators are quantized with the indicator profile of the job before they are classified, like Main classifies the tifs
+
+    def __init__(self, folder: str = None, main: Main = None):
+        self.main = main if main else Main()
+        self.folder = folder if folder else self.main.filepath_provider.get_job_folder()
+        self.queue = FileWorkQueue(self.folder)
+        self.meta_path = os.path.join(self.folder, 'job.json')
+        self.parts_folder = os.path.join(self.folder, 'parts')
+
+    def create(self):
+        main = self.main
+        all_reference_timeseries = main.get_all_reference_timeseries()
+        all_mm_paths = main.filepath_provider.get_input_mm_files_by_polarisation()
+        windows = main.indicator_calculation.get_raster_segmenter().get_windows(all_mm_paths['VV'])
+
+        os.makedirs(self.folder, exist_ok=True)
+        shutil.rmtree(self.parts_folder, ignore_errors=True)
+        os.makedirs(self.parts_folder)
+        meta = {'mm_paths': all_mm_paths, 'tif_info': main._get_tif_info(all_mm_paths['VV'][0]).to_dict(),
+                'indicator_key': main._get_indicator_key(all_reference_timeseries, all_mm_paths),
+                'indicator_profile': main.indicator_profile,
+                'references': [{'forest_type': ts.forest_type, 'polarization': ts.polarization, 'dates': ts.dates, 'sig0s': ts.sig0s}
+                               for ts in all_reference_timeseries]}
+        _write_json(self.meta_path, meta)
+        self.queue.create({f'window_{idx:06d}': {'window': list(window)} for idx, window in enumerate(windows)})
+        print(f'Created {len(windows)} tasks in {self.folder}')
+
+    def work(self, max_tasks: int = None) -> int:
+        # Processes tasks until there is none left, returns the number of processed tasks
+        meta = self.get_meta()
+        all_reference_timeseries = self.get_reference_timeseries(meta)
+        processed = 0
+        while max_tasks is None or processed < max_tasks:
+            claimed = self.queue.claim()
+            if claimed is None:
+                break
+            task_id, task = claimed
+            print(f'Processing {task_id} {task["window"]}')
+            try:
+                self.process(task_id, tuple(task['window']), meta['mm_paths'], all_reference_timeseries,
+                             self.main.tif_reader_writer.get_profile(meta['indicator_profile']))
+            except Exception:
+                self.queue.release(task_id)
+                raise
+            self.queue.complete(task_id)
+            processed += 1
+        print(f'Queue: {self.queue.get_progress()}')
+        return processed
+
+    def process(self, task_id: str, window: Tuple[int, int, int, int], all_mm_paths: Dict[str, List[str]],
+                all_reference_timeseries: List[Timeseries], indicator_profile: TifProfile):
+        indicator_calculation = self.main.indicator_calculation
+        tif_reader_writer = self.main.tif_reader_writer
+        raster_segmenter = indicator_calculation.get_raster_segmenter()
+        indicators = Indicators(capacity=len(all_reference_timeseries) * len(self.main.indicator_types))
+        arrays = {}
+        for polarization, mm_paths in all_mm_paths.items():
+            reference_timeseries = [ts for ts in all_reference_timeseries if ts.polarization == polarization]
+            if not reference_timeseries:
+                continue
+            cube = raster_segmenter.get_cube(mm_paths, window)
+            references = [indicator_calculation.get_reference(ts) for ts in reference_timeseries]
+            rmsd_cubes, pearson_cubes = indicator_calculation.get_indicator_cubes(cube, references)
+            for ts, rmsd_cube, pearson_cube in zip(reference_timeseries, rmsd_cubes, pearson_cubes):
+                for indicator_type, indicator_cube in [('rmsd', rmsd_cube), ('pearson', pearson_cube)]:
+                    indicator = tif_reader_writer.quantize(indicator_cube.data, indicator_profile)
+                    indicators.push(ts.forest_type, polarization, indicator_type, indicator)
+                    arrays[self._get_part_name(ts.forest_type, polarization, indicator_type)] = indicator
+            self.queue.heartbeat(task_id)
+        arrays['classified'] = self.main.forest_classification.classify_forest(indicators).astype(np.uint8)
+
+        part_path = self.get_part_path(task_id)
+        tmp_path = f'{part_path[:-len(".npz")]}.{socket.gethostname()}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, part_path)
+
+    def finalize(self) -> str:
+        # Assembles the indicator and classified tifs of all partial outputs, returns the classified path
+        if not self.queue.is_finished():
+            raise RuntimeError(f'Job {self.folder} is not finished: {self.queue.get_progress()}')
+        main = self.main
+        meta = self.get_meta()
+        tif_info = TifInfo.from_dict(meta['tif_info'])
+        indicator_profile = main.tif_reader_writer.get_profile(meta['indicator_profile'])
+        indicator_paths = {(ts.forest_type, ts.polarization, indicator_type):
+                           main.filepath_provider.get_indicator_file(indicator_type, ts.polarization, ts.forest_type)
+                           for ts in self.get_reference_timeseries(meta) for indicator_type in main.indicator_types}
+        classified_path = main.filepath_provider.get_classified_file()
+
+        writers = {key: TifWindowWriter(path, tif_info, profile=indicator_profile) for key, path in indicator_paths.items()}
+        classified_writer = TifWindowWriter(classified_path, tif_info, profile=main.tif_reader_writer.get_profile(main.classified_profile))
+        for task_id, task in sorted(self.queue.get_tasks().items()):
+            col_off, row_off = task['window'][:2]
+            with np.load(self.get_part_path(task_id)) as part:
+                for key, writer in writers.items():
+                    writer.write_cube(RasterCube(col_off, row_off, part[self._get_part_name(*key)]))
+                classified_writer.write_cube(RasterCube(col_off, row_off, part['classified']))
+        for writer in list(writers.values()) + [classified_writer]:
+            writer.close()
+
+        build_cache = main._get_build_cache()
+        build_cache.update(list(indicator_paths.values()), meta['indicator_key'])
+        build_cache.update([classified_path], main._get_classified_key(indicator_paths))
+        print(f'Finalized {len(self.queue.get_tasks())} tasks into {classified_path}')
+        return classified_path
+
+    def get_meta(self) -> dict:
+        with open(self.meta_path, 'r') as file:
+            return json.load(file)
+
+    def get_reference_timeseries(self, meta: dict) -> List[Timeseries]:
+        return [Timeseries(reference['dates'], reference['sig0s'], reference['forest_type'], reference['polarization'])
+                for reference in meta['references']]
+
+    def get_part_path(self, task_id: str) -> str:
+        return os.path.join(self.parts_folder, f'{task_id}.npz')
+
+    def _get_part_name(self, forest_type: str, polarization: str, indicator_type: str) -> str:
+        return f'{indicator_type}_{polarization}_{forest_type}'
+
+
+def _write_json(path: str, data):
+    # Written under a unique name and renamed, readers on other hosts never see a partial file
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Indicators and classification of one tile by workers sharing a job folder')
+    parser.add_argument('command', choices=['create', 'work', 'finalize'])
+    parser.add_argument('--folder', help='job folder on the shared filesystem, tmp/job of the base folder if not set')
+    parser.add_argument('--max-tasks', type=int)
+    args = parser.parse_args()
+
+    job = IndicatorJob(args.folder)
+    if args.command == 'create':
+        job.create()
+    elif args.command == 'work':
+        job.work(args.max_tasks)
+    else:
+        job.finalize()
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from forestdection.batch import BatchDriver, get_hlr_tile
+
+
+class RecordingDriver(BatchDriver):
+
+    def __init__(self, tiles_folder: str, tiles):
+        super().__init__(tiles_folder, tiles, memory_budget=1, tile_memory_budget=1, hlr_tiles={'E052N015T1': 'FTY_E40N20'})
+        self.processed = []
+
+    def _run_tile(self, tile: str, build: bool) -> dict:
+        self.processed.append((tile, self.get_hlr_tile(tile)))
+        return {'state': 'failed' if tile == 'E052N018T1' else 'done'}
+
+
+def test_batch_driver_skips_done_tiles(tmp_path):
+    tiles = ['E052N015T1', 'E052N018T1', 'E055N015T1']
+    driver = RecordingDriver(str(tmp_path), tiles)
+    driver.run()
+    assert driver.processed == [('E052N015T1', 'FTY_E40N20'), ('E052N018T1', None), ('E055N015T1', None)]
+
+    driver = RecordingDriver(str(tmp_path), tiles)
+    driver.run()
+    assert driver.processed == [('E052N018T1', None)]  # failed tiles only
+
+    driver.run(build=True)
+    assert [tile for tile, _ in driver.processed] == ['E052N018T1'] + tiles
+
+
+def test_get_hlr_tile(tmp_path):
+    base_folder = str(tmp_path)
+    with pytest.raises(ValueError):
+        get_hlr_tile(base_folder)
+
+    os.makedirs(os.path.join(base_folder, 'input', 'sentinel_hlr', 'FTY_2015_020m_eu_03035_d04_E40N20'))
+    assert get_hlr_tile(base_folder) == 'FTY_2015_020m_eu_03035_d04_E40N20'
+
+    os.makedirs(os.path.join(base_folder, 'input', 'sentinel_hlr', 'FTY_2015_020m_eu_03035_d04_E50N20'))
+    with pytest.raises(ValueError):
+        get_hlr_tile(base_folder)  # ambiguous
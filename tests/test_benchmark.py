@@ -0,0 +1,15 @@
+import os
+
+from forestdection.benchmark import Benchmark
+
+
+def test_benchmark(tmp_path):
+    benchmark = Benchmark()
+    stages = benchmark.run_case(64, 3, folder=os.path.join(str(tmp_path), 'data'))
+    assert list(stages) == ['reference_timeseries', 'rmsd', 'pearson', 'all_indicators', 'classify_forest', 'mmu', 'accuracy']
+    assert all(stage['mpix_per_s'] > 0 for stage in stages.values())
+
+    results = {benchmark.get_case_name(64, 3): stages}
+    baseline_path = os.path.join(str(tmp_path), 'baseline.json')
+    benchmark.write_results(results, baseline_path)
+    assert benchmark.compare(results, benchmark.read_results(baseline_path)) == []
@@ -0,0 +1,42 @@
+import os
+
+from forestdection.build_cache import BuildCache, WindowJournal
+
+
+def test_build_cache(tmp_path):
+    manifest_path = os.path.join(str(tmp_path), 'manifest.json')
+    input_path = os.path.join(str(tmp_path), 'input.csv')
+    artifact_path = os.path.join(str(tmp_path), 'artifact.tif')
+    for path in [input_path, artifact_path]:
+        with open(path, 'w') as file:
+            file.write('a')
+
+    build_cache = BuildCache(manifest_path)
+    key = build_cache.get_key([input_path], {'threshold': 1.5})
+    assert not build_cache.is_valid([artifact_path], key)
+
+    build_cache.update([artifact_path], key)
+    assert BuildCache(manifest_path).is_valid([artifact_path], key)
+
+    # changed parameter, code version and input
+    assert build_cache.get_key([input_path], {'threshold': 2.0}) != key
+    assert build_cache.get_key([input_path], {'threshold': 1.5}, version=2) != key
+    with open(input_path, 'w') as file:
+        file.write('b')
+    assert not build_cache.is_valid([artifact_path], build_cache.get_key([input_path], {'threshold': 1.5}))
+
+
+def test_window_journal(tmp_path):
+    journal_path = os.path.join(str(tmp_path), 'journal.jsonl')
+    journal = WindowJournal(journal_path, 'key')
+    assert not journal.has_progress()
+    journal.add((0, 0, 10, 10))
+    with open(journal_path, 'a') as file:
+        file.write('[10, 0,')  # torn line of a crash
+
+    journal = WindowJournal(journal_path, 'key')
+    assert journal.is_done((0, 0, 10, 10))
+    journal.add((10, 0, 10, 10))
+    assert WindowJournal(journal_path, 'key').is_done((10, 0, 10, 10))
+    assert not WindowJournal(journal_path, 'other key').has_progress()
+    assert not WindowJournal(journal_path, 'key').has_progress()  # removed by the other key
@@ -0,0 +1,60 @@
+import os
+
+from forestdection.catalog import RasterCatalog, parse_mm_filename
+
+
+class CountingCatalog(RasterCatalog):
+
+    def __init__(self, folder: str, catalog_path: str):
+        super().__init__(folder, catalog_path)
+        self.opened = []
+
+    def _get_tif_info_dict(self, path: str) -> dict:
+        self.opened.append(os.path.basename(path))
+        return {'path': path}
+
+
+def create_mm_file(folder, year: int, month: int, polarization: str, tile: str = 'E052N015T1'):
+    name = f'M{year}{month:02d}01_{year}{month:02d}28--_SIG0-----_{polarization}D----_A0000_1_EU010M_{tile}.tif'
+    with open(os.path.join(folder, name), 'w') as file:
+        file.write(name)
+    return name
+
+
+def touch_folder(folder, offset: int):
+    stat = os.stat(folder)
+    os.utime(folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset))
+
+
+def test_parse_mm_filename():
+    entry = parse_mm_filename('M20170101_20170131--_SIG0-----_VHD----_A0000_1_EU010M_E052N015T1.tif')
+    assert entry['date'] == '2017-01' and entry['polarization'] == 'VH'
+    assert entry['grid'] == 'EU010M' and entry['tile'] == 'E052N015T1'
+    assert parse_mm_filename('readme.txt') is None
+
+
+def test_raster_catalog(tmp_path):
+    folder = str(tmp_path / 'mm')
+    os.makedirs(folder)
+    catalog_path = str(tmp_path / 'catalog.json')
+    for year in [2016, 2017, 2018]:
+        for month in [1, 6, 12]:
+            for polarization in ['VV', 'VH']:
+                create_mm_file(folder, year, month, polarization)
+    create_mm_file(folder, 2017, 3, 'VH', tile='E040N020T1')
+
+    catalog = CountingCatalog(folder, catalog_path)
+    paths = catalog.get_paths(polarization='VH', date_from='2017-01', date_to='2018-12', tile='E052N015T1')
+    assert [os.path.basename(path)[1:7] for path in paths] == ['201701', '201706', '201712', '201801', '201806', '201812']
+    assert len(catalog.opened) == 19
+    assert catalog.get_entry(paths[0])['tif_info'] == {'path': paths[0]}
+
+    # a new process reads the persisted catalog without opening any file
+    catalog = CountingCatalog(folder, catalog_path)
+    assert len(catalog.get_paths(tile='E040N020T1')) == 1 and catalog.opened == []
+
+    # a new file changes the folder mtime, only the new file is opened
+    name = create_mm_file(folder, 2019, 1, 'VV')
+    touch_folder(folder, 1000)
+    assert len(catalog.get_paths(polarization='VV')) == 10
+    assert catalog.opened == [name]
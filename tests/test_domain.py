@@ -1,4 +1,6 @@
-from forestdection.domain import TifInfo
+import numpy as np
+
+from forestdection.domain import TifInfo, Indicators
 from forestdection.filepath import get_filepath, FilepathProvider
 
 filepath_provider = FilepathProvider()
@@ -17,3 +19,24 @@ def test_tif_info():
     assert info.pixel_height == -2.5  # how?
     assert info.wkt_projection.split('AUTHORITY')[-1].split('","')[-1][:5] == '31256'
 
+
+def test_indicators():
+    indicators = Indicators(capacity=2)
+    for forest_type in ['broadleaf', 'coniferous']:
+        for polarization in ['VV', 'VH']:
+            indicators.push(forest_type, polarization, 'rmsd', np.full((4, 5), len(indicators.types)))
+            indicators.push(forest_type, polarization, 'pearson', np.full((4, 5), len(indicators.types)))
+
+    rmsd_vh = indicators.get_data_by_description(polarization='VH', type_='rmsd')
+    assert rmsd_vh.shape == (4, 5, 2)
+    assert (rmsd_vh[0, 0, :] == [2, 6]).all()
+    assert np.shares_memory(rmsd_vh, indicators.raster)
+
+    window = indicators.get_window((1, 2, 3, 2))
+    window_vv = window.get_data_by_description(forest_type='coniferous', polarization='VV')
+    assert window_vv.shape == (2, 3, 2)
+    assert (window_vv[0, 0, :] == [4, 5]).all()
+
+    window.push('mixed', 'VV', 'rmsd', np.full((2, 3), 8))
+    assert len(indicators.types) == 8 and ('mixed', 'VV', 'rmsd') not in indicators.index
+    assert (window.get_data_by_description(forest_type='mixed') == 8).all()
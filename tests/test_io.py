@@ -1,14 +1,25 @@
+import os
+from typing import List
+
 import numpy as np
 from osgeo import gdal
 
 from forestdection.domain import Timeseries, TifInfo, RasterCube
 from forestdection.filepath import FilepathProvider, get_filepath
-from forestdection.io2 import CsvReaderWriter, TifReaderWriter, RasterSegmenter
+from forestdection.gdal_cache import DatasetCache
+from forestdection.io2 import CsvReaderWriter, TifReaderWriter, RasterSegmenter, TimeseriesCube, CubePrefetcher, WarpedTifReader
 
 filepath_provider = FilepathProvider()
 test_folder = filepath_provider.get_test_folder()
 
 
+def create_tif(path: str, size_x: int, size_y: int, options: List[str]) -> str:
+    ds = gdal.GetDriverByName('GTiff').Create(path, size_x, size_y, 1, gdal.GDT_Int16, options)
+    ds.FlushCache()
+    del ds
+    return path
+
+
 def test_csv_read_write():
     # Paths
     output_path = get_filepath(test_folder, 'csv_read_write.csv')
@@ -63,3 +74,164 @@ def test_tif_writer():
     TifReaderWriter().write_tif(data=input_data, output_path=output_path, tif_info=input_tif_info)
     output_tif_info = TifInfo(output_path)
     assert input_tif_info == output_tif_info
+
+
+def test_dataset_cache():
+    input_path = get_filepath(test_folder, 'gelaendeschummerung.tif')
+    written_path = get_filepath(test_folder, 'gelaendeschummerung_written.tif')
+
+    dataset_cache = DatasetCache(max_size=1)
+    first = dataset_cache.open(input_path)
+    assert dataset_cache.open(input_path) is first
+    dataset_cache.open(written_path)
+    assert dataset_cache.open(input_path) is not first  # evicted by the second file
+
+    assert dataset_cache.get_stats() == {'hits': 1, 'misses': 3, 'open': 1, 'max_size': 1}
+
+
+def test_threaded_cube_reads():
+    input_paths = [get_filepath(test_folder, 'gelaendeschummerung.tif'), get_filepath(test_folder, 'gelaendeschummerung_written.tif')]
+    window = (0, 0, 100, 50)
+
+    cube = RasterSegmenter(read_threads=1).get_cube(input_paths, window)
+    threaded_cube = RasterSegmenter(read_threads=2).get_cube(input_paths, window)
+    assert threaded_cube.data.shape == (50, 100, 2)
+    assert np.array_equal(threaded_cube.data, cube.data, equal_nan=True)
+
+
+def test_cube_prefetcher(tmp_path):
+    cube_path = os.path.join(str(tmp_path), 'timeseries_cube.npy')
+    data = np.arange(10 * 4 * 3, dtype=np.float32).reshape((10, 4, 3))
+    np.save(cube_path, data)
+    raster_segmenter = RasterSegmenter()
+    windows = raster_segmenter.get_grid(4, 10, 4, 3)
+
+    prefetcher = CubePrefetcher(TimeseriesCube(cube_path).get_cube, windows, depth=2)
+    cubes = list(prefetcher)
+    assert [(cube.col_off, cube.row_off) for cube in cubes] == [window[:2] for window in windows]
+    assert (np.concatenate([cube.data for cube in cubes]) == data).all()
+    assert prefetcher.get_stats()['cubes'] == len(windows)
+
+    prefetcher = CubePrefetcher(TimeseriesCube(cube_path).get_cube, windows, depth=1)
+    for _ in prefetcher:
+        break  # stops the reader
+    assert prefetcher.thread is None
+
+
+def test_window_size(tmp_path):
+    tiled_path = create_tif(os.path.join(str(tmp_path), 'tiled.tif'), 1000, 700, ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=128'])
+    other_tiled_path = create_tif(os.path.join(str(tmp_path), 'other_tiled.tif'), 1000, 700, ['TILED=YES', 'BLOCKXSIZE=128', 'BLOCKYSIZE=256'])
+    striped_path = create_tif(os.path.join(str(tmp_path), 'striped.tif'), 1000, 700, ['BLOCKYSIZE=4'])
+
+    # multiples of the blocks of all inputs, at most col_size x row_size pixels
+    assert RasterSegmenter(600, 600).get_window_size([tiled_path]) == (512, 640)
+    assert RasterSegmenter(600, 600).get_window_size([tiled_path, other_tiled_path]) == (512, 512)
+    # full width, so a strip is decompressed once
+    assert RasterSegmenter(600, 600).get_window_size([striped_path]) == (1000, 360)
+
+    # Int16 read and Float32 decoded band per file and pixel
+    memory_budget = 300 * 300 * 6 * 2
+    raster_segmenter = RasterSegmenter(memory_budget=memory_budget)
+    assert raster_segmenter.get_block_layout([tiled_path, tiled_path]) == (256, 128, 1000, 12)
+    col_size, row_size = raster_segmenter.get_window_size([tiled_path, tiled_path])
+    assert (col_size, row_size) == (256, 256)
+    assert col_size * row_size * 12 <= memory_budget
+
+    windows = raster_segmenter.get_windows([tiled_path, tiled_path])
+    assert all(col_off % 256 == 0 and row_off % 128 == 0 for col_off, row_off, _, _ in windows)
+    assert sum(col_size * row_size for _, _, col_size, row_size in windows) == 1000 * 700
+    assert windows[-1] == (768, 512, 232, 188)
+
+
+def test_tif_profile_round_trip(tmp_path):
+    tif_reader_writer = TifReaderWriter()
+    tif_info = TifInfo.from_dict({'origin_x': 0., 'origin_y': 0., 'pixel_width': 1., 'pixel_height': -1., 'wkt_projection': '',
+                                  'size_x': 4, 'size_y': 2})
+
+    # rounded to 1 / factor, not truncated
+    data = np.array([[-10.006, 1.239, np.nan, 0.004], [3.141, -0.996, 2.5, -327.67]], dtype=np.float32)
+    int16_path = os.path.join(str(tmp_path), 'int16.tif')
+    int16_profile = tif_reader_writer.get_profile('indicator_int16')
+    tif_reader_writer.write_tif(data, int16_path, tif_info, profile=int16_profile)
+    expected = np.rint(data * 100).astype(np.float32) / np.float32(100)
+    decoded = tif_reader_writer.read_tif(int16_path, int16_profile.factor, int16_profile.nodata)
+    assert np.array_equal(decoded, expected, equal_nan=True)
+    assert decoded[0, 0] == np.float32(-10.01)
+    ds = gdal.Open(int16_path)
+    assert ds.GetRasterBand(1).ReadAsArray()[0, 2] == -9999  # nodata is stored unscaled, not as nodata * factor
+    del ds
+    assert np.array_equal(tif_reader_writer.quantize(data, int16_profile), expected, equal_nan=True)
+
+    classes = np.array([[0, 1, 2, np.nan], [2, np.nan, 1, 0]], dtype=np.float32)
+    byte_path = os.path.join(str(tmp_path), 'byte.tif')
+    byte_profile = tif_reader_writer.get_profile('classified')
+    tif_reader_writer.write_tif(classes, byte_path, tif_info, profile=byte_profile)
+    ds = gdal.Open(byte_path)
+    assert ds.GetRasterBand(1).DataType == gdal.GDT_Byte
+    assert ds.GetRasterBand(1).GetNoDataValue() == 255
+    assert ds.GetRasterBand(1).ReadAsArray()[0, 3] == 255
+    del ds
+    decoded = tif_reader_writer.read_tif(byte_path, byte_profile.factor, byte_profile.nodata)
+    assert np.array_equal(decoded, classes, equal_nan=True)
+
+
+def test_timeseries_cube_ingest(tmp_path):
+    folder = str(tmp_path)
+    tif_reader_writer = TifReaderWriter()
+    tif_info = TifInfo.from_dict({'origin_x': 0., 'origin_y': 0., 'pixel_width': 1., 'pixel_height': -1., 'wkt_projection': '',
+                                  'size_x': 7, 'size_y': 5})
+    data = np.random.RandomState(1).normal(-10, 2, (5, 7, 3)).astype(np.float32)
+    data[1, 2, :] = np.nan
+    data[3, 4, 1] = np.nan
+    paths = [os.path.join(folder, f'M2019{month + 1:02d}01_SIG0_VV.tif') for month in range(3)]
+    for idx, path in enumerate(paths):
+        tif_reader_writer.write_tif(data[:, :, idx], path, tif_info)
+
+    timeseries_cube = TimeseriesCube(os.path.join(folder, 'timeseries_cube.npy'))
+    timeseries_cube.ingest(paths)
+    assert timeseries_cube.exists()
+    assert timeseries_cube.get_meta()['dates'] == ['2019-01', '2019-02', '2019-03']
+    assert timeseries_cube.get_tif_info() == tif_info
+
+    # full width row bands, 3 decoded float32 months per pixel within the memory budget
+    assert timeseries_cube.get_windows(RasterSegmenter(memory_budget=7 * 2 * 12)) == [(0, 0, 7, 2), (0, 2, 7, 2), (0, 4, 7, 1)]
+
+    for window in [(2, 1, 4, 3), (0, 0, 7, 5)]:
+        cube = timeseries_cube.get_cube(window)
+        expected = RasterSegmenter().get_cube(paths, window)
+        assert (cube.col_off, cube.row_off) == window[:2]
+        assert np.array_equal(cube.data, expected.data, equal_nan=True)
+
+
+def test_warped_tif_reader(tmp_path):
+    # HRL like source, 20 m pixels, nodata 0, warped onto a 10 m grid which is shifted and larger than its footprint
+    src_path = os.path.join(str(tmp_path), 'hrl.tif')
+    src = np.random.RandomState(0).randint(1, 4, size=(8, 10)).astype(np.uint8)
+    src[2, 3] = 0
+    ds = gdal.GetDriverByName('GTiff').Create(src_path, 10, 8, 1, gdal.GDT_Byte)
+    ds.SetGeoTransform((1000., 20., 0, 2000., 0, -20.))
+    ds.GetRasterBand(1).SetNoDataValue(0)
+    ds.GetRasterBand(1).WriteArray(src)
+    ds.FlushCache()
+    del ds
+
+    tif_info = TifInfo.from_dict({'origin_x': 980., 'origin_y': 2020., 'pixel_width': 10., 'pixel_height': -10., 'wkt_projection': '',
+                                  'size_x': 26, 'size_y': 20})
+    expected = np.full((20, 26), np.nan, dtype=np.float32)
+    for row in range(20):
+        for col in range(26):
+            # nearest source pixel of the pixel center
+            src_row, src_col = int((2000. - (2015. - 10 * row)) // 20), int(((985. + 10 * col) - 1000.) // 20)
+            if 0 <= src_row < 8 and 0 <= src_col < 10 and src[src_row, src_col]:
+                expected[row, col] = src[src_row, src_col]
+
+    reader = WarpedTifReader(src_path, tif_info)
+    assert reader.nodata == 0
+    data = reader.read_window((0, 0, 26, 20), decoder_factor=1)
+    assert np.array_equal(data, expected, equal_nan=True)
+    assert np.isnan(data[0, 0]) and np.isnan(data[6, 8])  # outside of the footprint and source nodata 0
+    assert np.count_nonzero(np.isnan(data)) == 26 * 20 - 20 * 16 + 4
+    assert np.array_equal(reader.read_window((3, 4, 10, 6), decoder_factor=1), expected[4:10, 3:13], equal_nan=True)
+
+    reader.close()
+    assert reader.dataset is None and reader.src_dataset is None
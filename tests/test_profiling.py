@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+from forestdection.profiling import StageProfiler
+
+
+def test_stage_profiler(tmp_path):
+    disabled_profiler = StageProfiler(enabled=False)
+    with disabled_profiler.stage('read') as stage:
+        stage.add_bytes(10)
+    disabled_profiler.record('prefetch_stall', 1.0)
+    assert disabled_profiler.get_report() == []
+
+    profiler = StageProfiler(enabled=True)
+    profiler.start()
+    for _ in range(3):
+        with profiler.stage('read') as stage:
+            stage.add_bytes(10)
+    with profiler.stage('decode'):
+        pass
+    profiler.stop()
+
+    report = {row['stage']: row for row in profiler.get_report()}
+    assert list(report) == ['read', 'decode', 'total']
+    assert report['read']['calls'] == 3
+    assert report['read']['bytes_read'] == 30
+    assert report['total']['process_peak_rss_mb'] > 0
+
+    # the RSS growth is per stage, the high-water mark of the process is not
+    with profiler.stage('allocate'):
+        data = np.ones(50 * 1000 * 1000 // 8)
+    report = {row['stage']: row for row in profiler.get_report()}
+    if sys.platform.startswith('linux'):
+        assert report['allocate']['rss_delta_mb'] >= 40
+    assert report['decode']['rss_delta_mb'] < 40
+    del data
+
+    worker_stats = {'read': {'calls': 2, 'seconds': 1.0, 'bytes_read': 5, 'rss_delta': 0, 'process_peak_rss': 0}}
+    profiler.merge(worker_stats)
+    report = {row['stage']: row for row in profiler.get_report()}
+    assert report['read']['calls'] == 5
+    assert report['read']['bytes_read'] == 35
+
+    report_path = os.path.join(str(tmp_path), 'stage_report.json')
+    profiler.write_json(report_path)
+    with open(report_path) as file:
+        assert json.load(file)[0]['stage'] == 'read'
@@ -1,6 +1,15 @@
+import os
+from functools import partial
+
 import numpy as np
+from osgeo import ogr, osr
+from scipy.ndimage import generic_filter
 
-from forestdection.service import IndicatorCalculation
+from forestdection.build_cache import WindowJournal
+from forestdection.domain import Timeseries, TifInfo
+from forestdection.io2 import RasterSegmenter, TimeseriesCube, TifReaderWriter, TifProfile
+from forestdection.profiling import profiler
+from forestdection.service import IndicatorCalculation, ComparisonUtils, AccuracyMeasure, IndicatorStatistics, ReferenceUtils
 
 
 def test_get_centered_std_timeseries():
@@ -22,3 +31,306 @@ def test_get_centered_std_cube():
 
     ref = np.sqrt(((2 - 4/3)**2 + (1 - 4/3)**2 * 2) / 2)
     assert std[0, 0] == ref
+
+
+def test_get_rmsd_by_cube():
+    indicator_calculation = IndicatorCalculation()
+    data = np.ones((4, 5, 3))
+    data[0, 0, :] = np.nan
+    reference = np.array([1., 2., 3.])
+    rmsd = indicator_calculation.get_rmsd_by_cube(data, reference)
+
+    assert rmsd.shape == (4, 5)
+    assert np.isnan(rmsd[0, 0])
+    assert rmsd[1, 1] == np.sqrt(5 / 3)
+
+
+def test_get_rmsd_all_by_cube():
+    indicator_calculation = IndicatorCalculation()
+    indicator_calculation.rmsd_chunk_pixels = 7  # several chunks
+    data = np.random.RandomState(0).normal(size=(4, 5, 6)).astype(np.float32)
+    data[0, 0, :] = np.nan
+    data[1, 1, 2] = np.nan
+    references = np.random.RandomState(1).normal(size=(3, 6))
+    references[2, 4] = np.nan
+    data[2, 2, :] = references[0]
+    rmsd, counts = indicator_calculation.get_rmsd_all_by_cube(data, references)
+
+    # direct implementation, normalised by the months where pixel and reference are valid
+    squares = np.square(data[:, :, None, :] - references[None, None, :, :])
+    valid = ~np.isnan(squares)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = np.sqrt(np.nansum(squares, axis=3) / valid.sum(axis=3))
+
+    assert rmsd.shape == (4, 5, 3)
+    assert rmsd.dtype == np.float32
+    assert (counts == valid.sum(axis=3)).all()
+    assert np.isnan(rmsd[0, 0]).all()
+    assert rmsd[2, 2, 0] < 1e-3
+    assert np.allclose(rmsd, expected, equal_nan=True, atol=1e-5)
+
+
+def test_get_raster_segmenter():
+    indicator_calculation = IndicatorCalculation(workers=2, col_size=8, row_size=3, memory_budget=1000, read_threads=4)
+    raster_segmenter = indicator_calculation.get_raster_segmenter(16)
+    assert (raster_segmenter.col_size, raster_segmenter.row_size, raster_segmenter.memory_budget) == (8, 3, 500)  # one cube per worker
+    assert raster_segmenter.read_threads == 4
+    assert raster_segmenter.output_block_size == 16
+
+
+def test_write_rmsd_and_pearson_resume(tmp_path):
+    cube_path = os.path.join(str(tmp_path), 'timeseries_cube.npy')
+    np.save(cube_path, np.random.RandomState(0).normal(size=(20, 8, 4)).astype(np.float32))
+    timeseries = [Timeseries(['2019-01', '2019-02', '2019-03', '2019-04'], [1., 3., 2., 4.], 'broadleaf', 'VV')]
+    indicator_calculation = IndicatorCalculation(col_size=8, row_size=5, prefetch_depth=0)
+    raster_segmenter = RasterSegmenter()
+
+    def get_outputs():
+        return raster_segmenter.get_empty_raster([(0, 0, 8, 20)]), raster_segmenter.get_empty_raster([(0, 0, 8, 20)])
+
+    def write(rmsd, pearson, is_done=None, on_window=None):
+        indicator_calculation.write_rmsd_and_pearson(timeseries, TimeseriesCube(cube_path), [partial(raster_segmenter.insert_cube, rmsd)],
+                                                     [partial(raster_segmenter.insert_cube, pearson)], is_done, on_window)
+
+    expected_rmsd, expected_pearson = get_outputs()
+    write(expected_rmsd, expected_pearson)
+
+    # interrupted after two windows, resumed with the remaining ones
+    done = []
+
+    def interrupt(window):
+        done.append(window)
+        if len(done) == 2:
+            raise KeyboardInterrupt
+
+    rmsd, pearson = get_outputs()
+    try:
+        write(rmsd, pearson, on_window=interrupt)
+    except KeyboardInterrupt:
+        pass
+    resumed = []
+    write(rmsd, pearson, lambda window: window in done, resumed.append)
+
+    assert len(resumed) == 2
+    assert np.array_equal(rmsd, expected_rmsd, equal_nan=True)
+    assert np.array_equal(pearson, expected_pearson, equal_nan=True)
+
+
+def test_write_all_indicators_resume(tmp_path, capsys):
+    folder = str(tmp_path)
+    cube_path = os.path.join(folder, 'timeseries_cube.npy')
+    np.save(cube_path, np.random.RandomState(0).normal(size=(40, 12, 4)).astype(np.float32))
+    timeseries = [Timeseries(['2019-01', '2019-02', '2019-03', '2019-04'], [1., 3., 2., 4.], 'broadleaf', 'VV')]
+    tif_info = TifInfo.from_dict({'origin_x': 0., 'origin_y': 0., 'pixel_width': 1., 'pixel_height': -1., 'wkt_projection': '',
+                                  'size_x': 12, 'size_y': 40})
+    profile = TifProfile('Float32', block_size=16, predictor=3, factor=1, nodata=-9999)
+    indicator_calculation = IndicatorCalculation(col_size=12, row_size=10, prefetch_depth=0)
+    journal_path = os.path.join(folder, 'indicators_VV.jsonl')
+
+    def write(name, journal=None):
+        indicator_paths = {('broadleaf', 'VV', type_): os.path.join(folder, f'{type_}_{name}.tif') for type_ in ['rmsd', 'pearson']}
+        indicator_calculation.write_all_indicators(timeseries, {'VV': TimeseriesCube(cube_path)}, indicator_paths, tif_info, profile=profile,
+                                                   journals={'VV': journal} if journal else None)
+        return [TifReaderWriter().read_tif(path, profile.factor, profile.nodata) for path in indicator_paths.values()]
+
+    # interrupted after the first window, which is on disk and in the journal
+    journal = WindowJournal(journal_path, 'key')
+    add = journal.add
+
+    def interrupt(window):
+        add(window)
+        raise KeyboardInterrupt
+
+    journal.add = interrupt
+    try:
+        write('resumed', journal)
+    except KeyboardInterrupt:
+        pass
+
+    capsys.readouterr()
+    resumed = write('resumed', WindowJournal(journal_path, 'key'))
+    assert 'Resuming after 1/3 windows' in capsys.readouterr().out
+    windows = WindowJournal(journal_path, 'key').windows
+    assert sorted(windows) == [(0, 0, 12, 16), (0, 16, 12, 16), (0, 32, 12, 8)]  # whole output blocks
+    for indicator, expected in zip(resumed, write('expected')):
+        assert np.array_equal(indicator, expected, equal_nan=True)
+
+
+def test_parallel_indicators(tmp_path, monkeypatch):
+    cube_path = os.path.join(str(tmp_path), 'timeseries_cube.npy')
+    data = np.random.RandomState(0).normal(size=(23, 8, 6)).astype(np.float32)
+    data[2, 3, :] = np.nan
+    np.save(cube_path, data)
+    dates = [f'2019-{month:02d}' for month in range(1, 7)]
+    timeseries = [Timeseries(dates, [1., 3., 2., 4., np.nan, 2.], 'broadleaf', 'VV'),
+                  Timeseries(dates, [0., -1., 1., 0., 2., 1.], 'coniferous', 'VV')]
+
+    # 8 windows of 3 rows, more than the 4 windows in flight
+    serial_calculation = IndicatorCalculation(workers=1, col_size=8, row_size=3)
+    all_rmsd, all_pearson = serial_calculation.get_rmsd_and_pearson(timeseries, TimeseriesCube(cube_path))
+    parallel_calculation = IndicatorCalculation(workers=2, col_size=8, row_size=3)
+    monkeypatch.setattr(profiler, 'enabled', True)
+    profiler.reset()
+    parallel_rmsd, parallel_pearson = parallel_calculation.get_rmsd_and_pearson(timeseries, TimeseriesCube(cube_path))
+    for indicator, parallel_indicator in zip(all_rmsd + all_pearson, parallel_rmsd + parallel_pearson):
+        assert np.array_equal(indicator, parallel_indicator, equal_nan=True)
+
+    # the stages run in the workers, the calling process merges them per window
+    assert profiler.get_stats()['moments']['calls'] == 8
+    profiler.reset()
+
+
+def test_indicator_statistics(tmp_path):
+    folder = str(tmp_path)
+    data = np.random.RandomState(0).normal(-10, 2, size=(12, 9, 5))
+    data[0, 0, :] = np.nan
+    data[3, 4, 1] = np.nan
+    data[5, :, 2] = np.nan
+    tif_info = TifInfo.from_dict({'origin_x': 0., 'origin_y': 0., 'pixel_width': 1., 'pixel_height': -1., 'wkt_projection': '',
+                                  'size_x': 9, 'size_y': 12})
+    dates = [f'2017-{month + 1:02d}' for month in range(5)]
+    mm_paths = [os.path.join(folder, f'M2017{month + 1:02d}01_SIG0_VV.tif') for month in range(5)]
+    for month, mm_path in enumerate(mm_paths):
+        TifReaderWriter().write_tif(data[:, :, month], mm_path, tif_info)
+    timeseries = [Timeseries(dates, [-9., -11., -10., -8., -12.], 'broadleaf', 'VV'),
+                  Timeseries(dates, [-10., np.nan, -9., -10., -11.], 'coniferous', 'VV')]
+
+    statistics = IndicatorStatistics(os.path.join(folder, 'statistics'), col_size=4, row_size=5)
+    os.makedirs(statistics.folder)
+    statistics.create(['broadleaf', 'coniferous'], 9, 12)
+    for mm_path, date in zip(mm_paths, dates):
+        if date == '2017-03':
+            # crash in the middle of the month, after a part of a window is written, nothing is counted twice
+            write_window = statistics._write_window
+
+            def crash(stats, window, values):
+                if window[1] >= 5:
+                    write_window(stats, window, {'count': values['count'], 'sum': values['sum']})
+                    raise KeyboardInterrupt
+                write_window(stats, window, values)
+
+            statistics._write_window = crash
+            try:
+                statistics.add_month(mm_path, statistics.get_reference_values(timeseries, date))
+            except KeyboardInterrupt:
+                pass
+            del statistics._write_window
+            assert statistics.get_dates() == dates[:2]
+        statistics.add_month(mm_path, statistics.get_reference_values(timeseries, date))
+
+    raster_segmenter = RasterSegmenter()
+    all_rmsd = [raster_segmenter.get_empty_raster([(0, 0, 9, 12)]) for _ in timeseries]
+    all_pearson = [raster_segmenter.get_empty_raster([(0, 0, 9, 12)]) for _ in timeseries]
+    statistics.write_indicators(timeseries, [partial(raster_segmenter.insert_cube, rmsd) for rmsd in all_rmsd],
+                                [partial(raster_segmenter.insert_cube, pearson) for pearson in all_pearson])
+
+    expected_rmsd, expected_pearson = IndicatorCalculation(prefetch_depth=0).get_rmsd_and_pearson(timeseries, mm_paths)
+    for indicator, expected in zip(all_rmsd + all_pearson, expected_rmsd + expected_pearson):
+        assert np.array_equal(np.isnan(indicator), np.isnan(expected))
+        assert np.allclose(indicator, expected, equal_nan=True, atol=1e-5)
+
+    assert statistics.is_valid(timeseries, mm_paths, 9, 12)
+    timeseries[1].sig0s[2] = -9.5
+    assert not statistics.is_valid(timeseries, mm_paths, 9, 12)
+
+
+def test_get_pearson_by_cube():
+    indicator_calculation = IndicatorCalculation()
+    data = np.random.RandomState(0).normal(size=(6, 7, 5))
+    data[0, 0, :] = np.nan
+    data[1, 1, 2] = np.nan
+    reference_std, reference_centered = indicator_calculation.get_centered_std_timeseries([1, 3, 2, 5, 4])
+    pearson = indicator_calculation.get_pearson_by_cube(data, reference_std, reference_centered)
+
+    # centered cube implementation
+    cube_std, cube_centered = indicator_calculation.get_centered_std_cube(data)
+    expected = np.nansum(cube_centered * reference_centered, axis=2) / (data.shape[2] - 1) / (cube_std * reference_std)
+
+    assert np.isnan(pearson[0, 0])
+    assert np.allclose(pearson, expected, equal_nan=True)
+
+
+def test_apply_mmu():
+    comparison_utils = ComparisonUtils()
+    data = np.random.RandomState(0).randint(0, 3, size=(20, 30)).astype(float)
+    data[5, 5] = np.nan
+
+    def check_mmu(values):
+        return int(np.nansum(values) >= 5)
+
+    expected = generic_filter(data, check_mmu, footprint=np.ones((3, 3)))
+    assert (comparison_utils.apply_mmu(data, 3, 5) == expected).all()
+
+
+def test_apply_mmu_area():
+    comparison_utils = ComparisonUtils()
+    data = np.zeros((6, 6))
+    data[0:3, 0:3] = 1
+    data[5, 5] = 2
+    filtered = comparison_utils.apply_mmu_area(data, min_area=4, connectivity=1)
+
+    assert (filtered[0:3, 0:3] == 1).all()
+    assert filtered[5, 5] == 0
+
+
+def test_accuracy_measure():
+    accuracy_measure = AccuracyMeasure()
+    hrl = np.array([0, 0, 1, 1, 2, 2, 255, 1])
+    classified = np.array([0, 1, 1, 1, 2, 0, 1, np.nan])
+
+    matrix = accuracy_measure.get_confusion_matrix(classified[:4], hrl[:4])
+    matrix = accuracy_measure.get_confusion_matrix(classified[4:], hrl[4:], matrix)
+    assert (matrix == np.array([[1, 1, 0], [0, 2, 0], [1, 0, 1]])).all()
+
+    measures = accuracy_measure.get_measures(matrix)
+    assert measures['overall_accuracy'] == 4 / 6
+    assert np.isclose(measures['kappa'], (4 / 6 - 12 / 36) / (1 - 12 / 36))
+    assert (measures['producers_accuracy'] == np.array([1 / 2, 1, 1 / 2])).all()
+
+
+def test_reference_timeseries(tmp_path):
+    folder = str(tmp_path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3035)
+    tif_info = TifInfo.from_dict({'origin_x': 1000., 'origin_y': 2000., 'pixel_width': 10., 'pixel_height': -10.,
+                                  'wkt_projection': srs.ExportToWkt(), 'size_x': 20, 'size_y': 16})
+    data = np.random.RandomState(0).normal(-10, 2, size=(16, 20, 3))
+    data[8, 6, 1] = np.nan
+    mm_paths = [os.path.join(folder, f'M2017{month + 1:02d}01_SIG0_VV.tif') for month in range(3)]
+    for month, mm_path in enumerate(mm_paths):
+        TifReaderWriter().write_tif(data[:, :, month], mm_path, tif_info)
+
+    # L shaped polygon, pixel centers of cols 5 - 11 in rows 7 - 8 and of cols 8 - 11 in rows 9 - 10 are inside
+    shape_path = os.path.join(folder, 'broadleaf.shp')
+    ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(shape_path)
+    layer = ds.CreateLayer('broadleaf', srs, ogr.wkbPolygon)
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in [(1050, 1930), (1120, 1930), (1120, 1890), (1080, 1890), (1080, 1910), (1050, 1910), (1050, 1930)]:
+        ring.AddPoint_2D(x, y)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    feature = None
+    del layer
+    del ds
+
+    expected_mask = np.zeros((4, 7), dtype=bool)
+    expected_mask[:2] = True
+    expected_mask[2:, 3:] = True
+    reference_utils = ReferenceUtils()
+    mask, window = reference_utils.tif_reader.rasterize_shape(shape_path, tif_info)
+    assert window == (5, 7, 7, 4)  # only the extent of the layer is rasterized
+    assert np.array_equal(mask, expected_mask)
+
+    reference_mask = reference_utils.get_reference_mask(shape_path, mm_paths[0])
+    assert reference_mask[1] == (5, 7, 7, 4)
+    assert np.array_equal(reference_mask[0], expected_mask)
+
+    timeseries = reference_utils.get_reference_timeseries('broadleaf', shape_path, mm_paths, reference_mask)
+    assert timeseries.dates == ['2017-01', '2017-02', '2017-03']
+    for mm_path, sig0 in zip(mm_paths, timeseries.sig0s):
+        expected = np.nanmean(TifReaderWriter().read_tif(mm_path)[7:11, 5:12][expected_mask])
+        assert np.isclose(sig0, expected)
+    assert timeseries.sig0s == reference_utils.get_reference_timeseries('broadleaf', shape_path, mm_paths).sig0s
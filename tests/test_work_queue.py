@@ -0,0 +1,93 @@
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from forestdection.benchmark import SyntheticDataGenerator
+from forestdection.filepath import FilepathProvider
+from forestdection.main import Main
+from forestdection.service import IndicatorCalculation
+from forestdection.work_queue import FileWorkQueue, IndicatorJob
+
+
+def claim_all(folder: str):
+    queue = FileWorkQueue(folder)
+    claimed = []
+    task = queue.claim()
+    while task:
+        task_id, _ = task
+        time.sleep(0.001)
+        queue.complete(task_id, {'pid': os.getpid()})
+        claimed.append(task_id)
+        task = queue.claim()
+    return claimed
+
+
+def work_job(base_folder: str, job_folder: str) -> int:
+    FilepathProvider.base_folder = base_folder
+    return IndicatorJob(job_folder).work()
+
+
+def test_file_work_queue(tmp_path):
+    folder = str(tmp_path)
+    queue = FileWorkQueue(folder)
+    queue.create({f'window_{idx:03d}': {'window': [idx, 0, 1, 1]} for idx in range(40)})
+
+    with Pool(4) as pool:
+        claimed = pool.map(claim_all, [folder] * 4)
+
+    all_claimed = [task_id for worker_claimed in claimed for task_id in worker_claimed]
+    assert sorted(all_claimed) == sorted(queue.get_tasks())  # every task exactly once
+    assert queue.is_finished()
+    assert queue.get_progress() == {'tasks': 40, 'done': 40, 'claimed': 0, 'failed': 0}
+
+
+def test_file_work_queue_stale_claim(tmp_path):
+    folder = str(tmp_path)
+    queue = FileWorkQueue(folder)
+    queue.create({'window_000': {'window': [0, 0, 1, 1]}})
+
+    crashed = FileWorkQueue(folder)
+    assert crashed.claim()[0] == 'window_000'
+    assert FileWorkQueue(folder).claim() is None  # claimed by a live worker
+
+    crashed.release('window_000')  # as if its heartbeat stopped
+    worker = FileWorkQueue(folder)
+    assert worker.claim()[0] == 'window_000'
+    worker.complete('window_000')
+    assert queue.is_finished()
+
+
+def test_indicator_job(tmp_path):
+    base_folder = os.path.join(str(tmp_path), 'data')
+    job_folder = os.path.join(str(tmp_path), 'job')
+    SyntheticDataGenerator(base_folder, 512, 4).generate()
+    previous_base_folder = FilepathProvider.base_folder
+    FilepathProvider.base_folder = base_folder
+    try:
+        main = Main()
+        main.indicator_calculation = IndicatorCalculation(col_size=256, row_size=256)
+        main.indicator_profile = 'indicator_int16'  # classified after quantization, like the tifs
+        job = IndicatorJob(job_folder, main)
+        job.create()
+        with Pool(2) as pool:
+            processed = pool.starmap(work_job, [(base_folder, job_folder)] * 2)
+        assert sum(processed) == len(job.queue.get_tasks()) == 4
+
+        classified_path = job.finalize()
+        indicator_paths = main.build_all_indicators()  # registered by finalize
+        indicator_profile = main.tif_reader_writer.get_profile(main.indicator_profile)
+
+        def read_all():
+            paths = list(indicator_paths.values())
+            return [main.tif_reader_writer.read_tif(path, indicator_profile.factor, indicator_profile.nodata) for path in paths] + \
+                [main.tif_reader_writer.read_tif(classified_path, decoder_factor=1, decoder_nodata=255)]
+
+        job_results = read_all()
+        main.build_all_indicators(build=True)
+        main.build_classified(build=True)
+        for job_result, result in zip(job_results, read_all()):
+            assert np.array_equal(job_result, result, equal_nan=True)
+    finally:
+        FilepathProvider.base_folder = previous_base_folder